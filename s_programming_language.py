@@ -2,32 +2,51 @@
 # Author: David Niblick
 # Date: 20250903
 
+from array import array
+from bisect import bisect_left, bisect_right, insort
+from collections.abc import Sequence
+from dataclasses import dataclass, field
 from itertools import count
-from copy import deepcopy
+from types import MappingProxyType
+from functools import cached_property, lru_cache, partial
+
+try:  # optional: native run loop for compiled programs
+    import numpy as np
+    from numba import njit
+except ImportError:
+    np = njit = None
 
 class SMachine:
     """
     S-language VM with recursive, parameterized macros and per-call namespaces.
-    Supports step-by-step execution, full state history, and program/macros editing.
+    Supports step-by-step execution, state history with rewind (opt in with
+    history=True), and program/macros editing.
     """
 
     # ---------- construction ----------
 
-    def __init__(self, macros=None):
+    def __init__(self, macros=None, history=False, history_stride=256):
         self.macros = {}               # name -> (params, code, locals[])
+        self.builtins = {}             # name -> memoized native implementation
+        self._bodies = {}              # name -> (macro, flat body, labels, ops), see _macro_body
+        self._escapes = None           # name -> outward label lookups, see _label_escapes
+        self._escapes_for = {}         # the macros _escapes was computed for
+        self._frame_pool = []          # finished _Frames to reuse for calls when history is off
         if macros:
             for k, v in macros.items():
                 self.add_macro(k, *v)
 
         self.inputs = {}
         self.program_src = []          # raw program with labels
-        self.program_flat = []         # flattened program (no labels)
+        self.program_flat = ()         # flattened program (no labels)
         self.program_labels = {}       # label -> index in program_flat
         self.vars = {}                 # global variable store
-        self.stack = []                # call stack of frames (dicts)
+        self.stack = []                # call stack of _Frame
         self._call_ids = count()       # unique suffix ids
         self.step_count = 0
-        self.history = []              # list of snapshots
+        self.history = _History(self)  # per-step undo journal, indexable like snapshots
+        self.record_history = history  # off: no journal, so no rewind or print_state(idx)
+        self.history_stride = history_stride  # snapshots between history checkpoints; 0: none
 
     # ---------- user API: editing ----------
 
@@ -97,6 +116,49 @@ class SMachine:
         for n in names:
             self.macros.pop(n, None)
 
+    def register_builtin(self, name: str, fn):
+        """
+        Opt in to a native implementation of a macro, e.g.
+        register_builtin("recurse_factorial", math.factorial).
+        A call (name, out, a, b, ...) then sets out = fn(a, b, ...) in one step,
+        in both step() and the compiled engine, instead of expanding the macro.
+        Results are memoized per argument tuple. Only the first argument is
+        written, so fn must match the macro's effect on its output variable.
+        """
+        if not isinstance(name, str) or not name:
+            raise ValueError("Builtin name must be a non-empty string")
+        if not callable(fn):
+            raise ValueError("fn must be callable")
+        self.builtins[name] = lru_cache(maxsize=None)(fn)
+
+    def memoize_macro(self, name: str, max_steps=100_000):
+        """
+        Opt in to memoizing a pure macro, e.g. memoize_macro("mul").
+        The macro (as currently defined) is compiled once and registered as a
+        builtin: the first call with given argument values runs it, later calls
+        with the same values set out in one step. As with register_builtin,
+        only the first argument is written, so the macro must set it from the
+        values of the others alone.
+        """
+        if name not in self.macros:
+            raise ValueError(f"Unknown macro {name}")
+        params = [f"x{i}" for i in range(1, len(self.macros[name][0]))]
+        program = compile_program([(name, "y", *params)], self.macros, self.builtins)
+        if _reads_slot(program, program.y_slot):
+            raise ValueError(f"Macro {name} may read its output before setting it")
+
+        def fn(*values):
+            vars_ = program.make_vars(dict(zip(params, values)))
+            if _execute(program, vars_, max_steps) >= max_steps:
+                raise _step_limit_error()
+            return vars_[program.y_slot]
+
+        self.register_builtin(name, fn)
+
+    def remove_builtin(self, name: str):
+        """Drop a builtin so the macro of that name expands again. No error if absent."""
+        self.builtins.pop(name, None)
+
     def print_macros(self):
         """Print all macro names and arities."""
         for name in self.list_macros():
@@ -119,175 +181,2018 @@ class SMachine:
         self._validate_inputs()
         self.vars = dict(self.inputs)
         self.vars.setdefault("y", 0)
-        self.program_flat, self.program_labels = self._resolve_labels(self.program_src, "")
-        self.stack = [self._make_frame(self.program_flat, self.program_labels, {})]
+        self.program_flat, self.program_labels = self._resolve_labels(self.program_src)
+        ops = self._decode(self.program_flat, self.program_labels)
+        self.stack = [self._make_frame(self.program_flat, self.program_labels, {}, ops)]
         self.step_count = 0
-        self.history = []
+        self.history = _History(self)
         # capture initial state
-        self._save_snapshot(current_instr=self._peek_next_instr())
+        self._record(None, None, (len(self.stack), (), None, 0))
 
     def run(self, max_steps=100_000, print_steps=None, trace=False):
         if not self.stack:
             self.reset()
+        if self._escapes_for != self.macros:  # macros changed since the escapes were computed
+            self._escapes = None
+        # pick the loop once rather than testing the print options every step
+        if trace:
+            self._run_traced(max_steps, print_steps, trace)
+        elif print_steps:
+            self._run_progress(max_steps, print_steps)
+        else:
+            self._run_fast(max_steps)
+        if self.step_count >= max_steps:
+            raise _step_limit_error()
+        return self.vars.get("y", 0)
+
+    def run_compiled(self, max_steps=100_000, memo=False):
+        """
+        Run the program from the start on compiled bytecode (see compile_program).
+        Variables live in a flat slot array during the run; afterwards `vars`
+        holds the inputs and every named variable. No history is recorded.
+        memo=True reuses the outcome of an earlier identical run (see run_program).
+        """
+        run = _run_memo if memo else _run_named
+        self.step_count, named = run(self.program_src, self.inputs, self.macros, self.builtins,
+                                     max_steps)
+        self.vars = {**self.inputs, **named}
+        self.stack = []
+        self.history = _History(self)
+        if self.step_count >= max_steps:
+            raise _step_limit_error()
+        return named["y"]
+
+    def _run_traced(self, max_steps, print_steps, trace):
         while self.stack and self.step_count < max_steps:
             if (print_steps and self.step_count > 0) and (self.step_count % print_steps == 0):
                 print(f'Executing step {self.step_count}')
             self.step(trace=trace)
-        if self.step_count >= max_steps:
-            raise RuntimeError("Maximum step count exceeded; possible undefined condition")
-        return self.vars.get("y", 0)
+
+    def _run_progress(self, max_steps, print_steps):
+        # _run_fast() in stretches that end on each multiple of print_steps
+        while self.stack and self.step_count < max_steps:
+            if self.step_count > 0 and self.step_count % print_steps == 0:
+                print(f'Executing step {self.step_count}')
+            self._run_fast(min((self.step_count // print_steps + 1) * print_steps, max_steps))
+
+    def _run_fast(self, max_steps):
+        # _step() over the top frame's decoded ops (see _decode) with its pc and
+        # map cached in locals: inc, dec, in-frame jumps and transfer loops run
+        # inline, calls go through _call() and the rest, returns included, through _step()
+        stack, vars_ = self.stack, self.vars
+        log, record = self.history.append, self.record_history
+        # the opcodes and _MISSING as locals: every step compares against them
+        op_inc, op_dec, op_jnz = OP_INC, OP_DEC, OP_JNZ
+        op_inc_rel, op_dec_rel, op_jnz_rel = OP_INC_REL, OP_DEC_REL, OP_JNZ_REL
+        op_absorb, op_call, missing = OP_ADD_ABSORB, OP_CALL, _MISSING
+        while stack and self.step_count < max_steps:
+            frame = stack[-1]
+            ops, pc, mapping, labels = frame.ops, frame.pc, frame.map, frame.labels
+            n, depth, steps, op = len(frame.code), len(stack), self.step_count, None
+            try:
+                while steps < max_steps:
+                    op, arg, target = ops[pc]  # the body's end decodes as OP_RET
+                    start = pc
+                    if op == op_inc_rel:
+                        var = mapping[arg]
+                        old = vars_.get(var, missing)
+                        vars_[var] = 1 if old is missing else old + 1
+                        pc += 1
+                    elif op == op_dec_rel:
+                        var = mapping[arg]
+                        old = vars_.get(var, missing)
+                        vars_[var] = old - 1 if old is not missing and old > 0 else 0
+                        pc += 1
+                    elif op == op_inc:
+                        var = arg
+                        old = vars_.get(var, missing)
+                        vars_[var] = 1 if old is missing else old + 1
+                        pc += 1
+                    elif op == op_dec:
+                        var = arg
+                        old = vars_.get(var, missing)
+                        vars_[var] = old - 1 if old is not missing and old > 0 else 0
+                        pc += 1
+                    elif op == op_jnz or op == op_jnz_rel:
+                        var = old = None
+                        if vars_.get(arg if op == op_jnz else mapping[arg], 0) == 0:
+                            pc += 1
+                        elif target is not None:
+                            pc = target
+                        else:
+                            label = frame.code[pc][2]
+                            target = _find_label(labels, mapping.get(label, label))
+                            if target is None:
+                                break  # outward: _step() unwinds (see _jump)
+                            pc = target
+                    elif op == op_absorb:
+                        # L: dec x; inc t...; jnz x L. Without history, and if
+                        # no t is x, all of its passes happen at once: with x = k
+                        # that is max(k, 1) passes of len(t) + 2 steps each
+                        rel, incs, end = target
+                        var = mapping[arg] if rel else arg
+                        old = vars_.get(var, missing)
+                        if not record:
+                            names = [mapping[t] if r else t for t, r in incs]
+                            passes = old if old is not missing and old > 0 else 1
+                            cost = passes * (len(names) + 2)
+                            if var not in names and steps + cost <= max_steps:
+                                for t in names:
+                                    vars_[t] = vars_.get(t, 0) + passes
+                                vars_[var] = 0
+                                steps += cost
+                                pc = end
+                                continue
+                        vars_[var] = old - 1 if old is not missing and old > 0 else 0
+                        pc += 1
+                    else:
+                        break
+                    steps += 1
+                    if record:
+                        nxt = frame.code[pc] if pc < n else None
+                        log((steps, depth, nxt, var, old, depth, (), frame, start))
+            finally:
+                frame.pc = pc
+                self.step_count = steps
+            if stack and self.step_count < max_steps and (
+                    op != op_call or not self._call(frame, arg, target, max_steps)):
+                self._step()
+
+    def _call(self, frame, name, target, max_steps):
+        # a macro call from _run_fast(), at frame's pc: the goto shortcut, a
+        # tail call in place of frame (see _tail_safe) or a new frame. False
+        # leaves it to _step(), which runs builtins and reports errors.
+        macro, body = self.macros.get(name), self._bodies.get(name)
+        args, tail, site = target
+        if macro is None or name in self.builtins or len(args) != len(macro[0]):
+            return False
+        if body is None or body[0] is not macro:
+            self._macro_body(name, macro)
+            body = self._bodies[name]
+        _, flat, labels, ops, jump = body
+        call_id = next(self._call_ids)
+        record, pool, stack = self.record_history, self._frame_pool, self.stack
+        if (jump is not None and not record and self.step_count + 3 <= max_steps
+                and self._goto(frame, jump, args, call_id)):
+            return True
+        new_map = self._call_map(site, macro, args, frame.map, call_id)
+        callee = self._make_frame(flat, labels, new_map, ops)
+        start, depth = frame.pc, len(stack)
+        frame.pc += 1
+        if tail and not record and self._tail_safe(name, new_map, frame.labels):
+            stack[-1] = callee
+            pool.append(frame)
+        else:
+            stack.append(callee)
+        self.step_count += 1
+        self._record(None, None, (depth, (), frame, start))
+        return True
+
+    def _goto(self, frame, jump, args, call_id):
+        # a goto-shaped call (see _macro_body) as its call, inc and jnz at once,
+        # without a frame or a map; False if no frame has the label
+        (vpos, var), (lpos, label) = jump
+        if vpos is not None:
+            var = f"{var}__m{call_id}" if vpos < 0 else frame.map.get(args[vpos], args[vpos])
+        if lpos is not None:
+            label = (f"{label}__m{call_id}" if lpos < 0
+                     else frame.map.get(args[lpos], args[lpos]))
+        target = _find_label(frame.labels, label)
+        if target is None:
+            stack = self.stack
+            for d in range(len(stack) - 2, -1, -1):
+                target = _find_label(stack[d].labels, label)
+                if target is not None:
+                    break
+            else:
+                return False
+            self._frame_pool.extend(stack[d + 1:])
+            del stack[d + 1:]
+            frame = stack[d]
+        self.vars[var] = self.vars.get(var, 0) + 1
+        self.step_count += 3
+        frame.pc = target
+        return True
 
     def step(self, trace=False):
-        """Execute exactly one instruction (or return from a frame). Saves state."""
+        """Execute exactly one instruction (or return from a frame); journaled if history is on."""
+        if trace and self.stack:
+            frame = self.stack[-1]
+            if frame.pc < len(frame.code):
+                print(f"step={self.step_count} depth={len(self.stack)} pc={frame.pc} "
+                      f"instr={frame.code[frame.pc]} vars={self.vars}")
+        return self._step()
+
+    def _step(self):
+        # step() without the trace check
         if not self.stack:
             return False  # halted
 
         frame = self.stack[-1]
-        code, pc, mapping = frame["code"], frame["pc"], frame["map"]
+        code, pc, mapping = frame.code, frame.pc, frame.map
 
         # finished frame → pop and save state
         if pc >= len(code):
             self.stack.pop()
-            self._save_snapshot(current_instr=self._peek_next_instr())
+            if self.record_history:
+                self._record(None, None, (len(self.stack), (frame,), None, 0))
+            else:
+                self._frame_pool.append(frame)
             return bool(self.stack)
 
-        instr = code[pc]
-        op, *args = instr
-
-        if trace:
-            print(f"step={self.step_count} depth={len(self.stack)} pc={pc} instr={instr} vars={self.vars}")
-
-        # primitives
-        if op == "inc":
-            v = mapping.get(args[0], args[0])
-            self.vars[v] = self.vars.get(v, 0) + 1
-            frame["pc"] += 1
-
-        elif op == "dec":
-            v = mapping.get(args[0], args[0])
-            self.vars[v] = max(0, self.vars.get(v, 0) - 1)
-            frame["pc"] += 1
-
-        elif op == "jnz":
-            v = mapping.get(args[0], args[0])
-            target_raw = args[1]
-            target = mapping.get(target_raw, target_raw)
-            if self.vars.get(v, 0) != 0:
-                self._jump(target)
+        # undo data for the history: the variable written and its old value,
+        # and (kept depth, removed frames, frame, old pc), built only when needed
+        var = old = undo = None
+
+        # dispatch on the frame's decoded ops (see _decode); the instruction
+        # itself is read only for a malformed primitive, decoded here ignoring
+        # extra operands, or a jump through the frame's map
+        kind, arg, target = frame.ops[pc]
+        if kind == OP_CALL:
+            op, args = arg, target[0]
+        elif kind is None:
+            instr = code[pc]
+            kind, arg = _PRIMITIVES[arg], mapping.get(instr[1], instr[1])
+            if kind == OP_JNZ and len(instr) < 3:
+                raise IndexError(f"jnz needs a variable and a label, got {instr}")
+        elif kind == OP_ADD_ABSORB:
+            kind = OP_DEC_REL if target[0] else OP_DEC  # one pass at a time here
+
+        if kind == OP_INC or kind == OP_INC_REL:
+            var = mapping[arg] if kind == OP_INC_REL else arg
+            old = self.vars.get(var, _MISSING)
+            self.vars[var] = 1 if old is _MISSING else old + 1
+            frame.pc += 1
+
+        elif kind == OP_DEC or kind == OP_DEC_REL:
+            var = mapping[arg] if kind == OP_DEC_REL else arg
+            old = self.vars.get(var, _MISSING)
+            self.vars[var] = old - 1 if old is not _MISSING and old > 0 else 0
+            frame.pc += 1
+
+        elif kind == OP_JNZ or kind == OP_JNZ_REL:
+            if self.vars.get(mapping[arg] if kind == OP_JNZ_REL else arg, 0) == 0:
+                frame.pc += 1
+            elif target is not None:
+                frame.pc = target
             else:
-                frame["pc"] += 1
+                target = code[pc][2]
+                target = mapping.get(target, target)
+                idx = _find_label(frame.labels, target)
+                if idx is not None:
+                    frame.pc = idx
+                else:
+                    undo = self._jump(target)
+
+        # native builtin: out = fn(inputs...)
+        elif op in self.builtins:
+            if not args:
+                raise ValueError(f"Builtin {op} needs an output variable")
+            values = [self.vars.get(mapping.get(a, a), 0) for a in args[1:]]
+            var = mapping.get(args[0], args[0])
+            old = self.vars.get(var, _MISSING)
+            self.vars[var] = _builtin_result(op, self.builtins[op](*values))
+            frame.pc += 1
 
         # macro call
         elif op in self.macros:
-            params, body, locals_list = self.macros[op]
-            if len(args) != len(params):
-                raise ValueError(f"Macro {op} expects {len(params)} args, got {len(args)}")
-            call_id = next(self._call_ids)
-            suffix = f"__m{call_id}"
-            new_map = {p: mapping.get(a, a) for p, a in zip(params, args)}
-            for loc in locals_list:
-                new_map[loc] = f"{loc}{suffix}"
-            flat_body, body_labels = self._resolve_labels(body, suffix)
-            frame["pc"] += 1
-            self.stack.append(self._make_frame(flat_body, body_labels, new_map))
+            macro = self.macros[op]
+            if len(args) != len(macro[0]):
+                raise ValueError(f"Macro {op} expects {len(macro[0])} args, got {len(args)}")
+            new_map = self._call_map(target[2], macro, args, mapping, next(self._call_ids))
+            flat_body, body_labels, body_ops = self._macro_body(op, macro)
+            frame.pc += 1
+            undo = (len(self.stack), (), frame, pc)
+            self.stack.append(self._make_frame(flat_body, body_labels, new_map, body_ops))
 
         else:
             raise ValueError(f"Unknown instruction {op}")
 
         self.step_count += 1
-        self._save_snapshot(current_instr=self._peek_next_instr())
+        if self.record_history:
+            self._record(var, old, undo or (len(self.stack), (), frame, pc))
         return True
 
     # ---------- inspection, history, rewind ----------
 
     def state(self):
-        """Return current state (shallow copy for quick inspection)."""
+        """Return current state: a copy of vars, read-only views of the top frame."""
         return {
             "step": self.step_count,
             "vars": dict(self.vars),
             "stack_depth": len(self.stack),
             "next_instr": self._peek_next_instr(),
-            "top_frame": deepcopy(self.stack[-1]) if self.stack else None,
+            "top_frame": self.stack[-1].as_dict() if self.stack else None,
         }
 
     def print_state(self, idx: int | None = None):
+        if idx is not None:
+            self._require_history()
         s = self.history[idx] if idx is not None else self.state()
         print(f"step={s['step']} depth={s.get('stack_depth', 0)} next={s.get('next_instr')}")
         print("vars:", {k: v for k, v in sorted(s["vars"].items())})
 
     def rewind(self, idx: int):
-        """Restore machine to a previous snapshot index."""
-        snap = self.history[idx]
-        # deep restore to avoid aliasing
-        self.vars = deepcopy(snap["vars"])
-        self.stack = deepcopy(snap["stack"])
-        self.step_count = snap["step"]
+        """
+        Restore machine to a previous snapshot index by undoing the later steps.
+        History after idx is discarded, so stepping on continues from there.
+        """
+        self._require_history()
+        self.history.rewind(idx)
         # keep program/macros as-is
 
 
     # ---------- internals ----------
 
+    def _require_history(self):
+        if not self.record_history:
+            raise RuntimeError("No history recorded; create the SMachine with history=True")
+
+    def _make_frame(self, code, labels, mapping, ops):
+        # code, labels and ops are never mutated, so frames of one macro share
+        # them; callers build a fresh mapping per call, so it is not copied
+        # again. Without history a finished frame from the pool is reused.
+        if self._frame_pool and not self.record_history:
+            frame = self._frame_pool.pop()
+            frame.code, frame.pc, frame.labels, frame.map, frame.ops = code, 0, labels, mapping, ops
+            return frame
+        return _Frame(code, 0, labels, mapping, ops)
+
     @staticmethod
-    def _make_frame(code, labels, mapping):
-        return {"code": list(code), "pc": 0, "labels": dict(labels), "map": dict(mapping)}
+    def _call_map(site, macro, args, mapping, call_id):
+        # a callee's map from its call site's template (see _bind_site), locals suffixed
+        if site[0] is not macro:
+            _bind_site(site, macro, args)
+        new_map = site[1].copy()
+        for p, a in site[2]:
+            new_map[p] = mapping[a]
+        for loc in macro[2]:
+            new_map[loc] = f"{loc}__m{call_id}"
+        return new_map
+
+    def _macro_body(self, name, macro):
+        # flat body, label table and decoded ops of a macro, once per definition.
+        # The cache entry also holds, for a goto-shaped body (inc v; jnz v L),
+        # (pos, name) of v and L: pos -1 for a local, a param index, or None.
+        cached = self._bodies.get(name)
+        if cached is None or cached[0] is not macro:
+            params, code, locals_ = macro
+            flat, labels = self._resolve_labels(code)
+            ops = self._decode(flat, labels, {*params, *locals_})
+            jump = None
+            if (len(flat) == 2 and not labels and ops[0][0] in (OP_INC, OP_INC_REL)
+                    and ops[1][0] in (OP_JNZ, OP_JNZ_REL) and flat[0][1] == flat[1][1]):
+                position = {p: i for i, p in enumerate(params)}  # last one wins, as in the map
+                jump = tuple((-1 if name in locals_ else position.get(name), name)
+                             for name in flat[1][1:])
+            cached = self._bodies[name] = (macro, flat, labels, ops, jump)
+        return cached[1:4]
 
     @staticmethod
-    def _resolve_labels(code, suffix):
-        labels, flat = {}, []
+    def _resolve_labels(code):
+        # the flat body is a tuple: frames and history snapshots share it
+        labels, flat = _Labels(), []
         for instr in code:
             op = instr[0]
             if op.endswith(":"):
-                labels[op[:-1] + suffix] = len(flat)
+                labels[op[:-1]] = len(flat)
             else:
                 flat.append(instr)
-        return flat, labels
+        labels.index_suffixed()
+        return tuple(flat), labels
 
-    def _find_label_in_frame(self, label, frame):
-        lbls = frame["labels"]
-        if label in lbls:
-            return lbls[label]
-        for k in lbls:
-            if k.startswith(label + "__"):
-                return lbls[k]
-        return None
+    @staticmethod
+    def _decode(flat, labels, bound=()):
+        # (opcode, operand, target) per instruction for _run_fast, *_REL for
+        # names bound in the frame's map; calls get (args, is tail call, site;
+        # see _bind_site), jnz its pc when known, and malformed primitives get
+        # None (left to _step).
+        # The dec heading a do-while transfer loop becomes OP_ADD_ABSORB with
+        # (dec is relative, ((inc operand, is relative), ...), pc after the jnz).
+        # One OP_RET past the last instruction ends the body, so _run_fast
+        # needs no bounds check on pc.
+        ops = []
+        for pc, instr in enumerate(flat):
+            op = instr[0]
+            rel = len(instr) > 1 and instr[1] in bound
+            if op == "inc" and len(instr) == 2:
+                ops.append((OP_INC_REL if rel else OP_INC, instr[1], None))
+            elif op == "dec" and len(instr) == 2:
+                ops.append((OP_DEC_REL if rel else OP_DEC, instr[1], None))
+            elif op == "jnz" and len(instr) == 3:
+                target = None if instr[2] in bound else labels.get(instr[2])
+                ops.append((OP_JNZ_REL if rel else OP_JNZ, instr[1], target))
+                if target is not None and target < pc and ops[target][0] in (OP_DEC, OP_DEC_REL) \
+                        and flat[target][1] == instr[1]:
+                    incs = ops[target + 1:pc]
+                    if all(o[0] in (OP_INC, OP_INC_REL) and o[1] != instr[1] for o in incs):
+                        # L: dec x; inc t...; jnz x L runs as one absorb (see _run_fast)
+                        refs = tuple((o[1], o[0] == OP_INC_REL) for o in incs)
+                        ops[target] = (OP_ADD_ABSORB, instr[1], (rel, refs, pc + 1))
+            elif op in ("inc", "dec", "jnz"):
+                ops.append((None, op, None))
+            else:
+                args = instr[1:]
+                site = [None, None, None, frozenset(a for a in args if a in bound)]
+                ops.append((OP_CALL, op, (args, pc == len(flat) - 1, site)))
+        ops.append((OP_RET, None, None))
+        return ops
+
+    def _label_escapes(self):
+        # per macro, the labels a call may look up outside its own frame (see
+        # _jump), transitively through the macros it calls: ("param", p) for
+        # the label passed as parameter p, ("name", t) for a literal label t.
+        # None if unknown (a jump to a local). Over-approximates, fixpoint
+        # over recursive macros.
+        bodies = {name: self._macro_body(name, m) for name, m in self.macros.items()}
+        escapes = dict.fromkeys(self.macros, frozenset())
+        changed = True
+        while changed:
+            changed = False
+            for name, (params, _, locals_) in self.macros.items():
+                flat, labels, _ = bodies[name]
+
+                def outside(t):
+                    # a label named t in this body, as seen from its callers
+                    if t in params:
+                        return {("param", t)}
+                    if t in locals_:
+                        return None
+                    return set() if _find_label(labels, t) is not None else {("name", t)}
+
+                found = set()
+                for instr in flat:
+                    op = instr[0]
+                    if op == "jnz" and len(instr) == 3:
+                        more = outside(instr[2])
+                    elif op in self.macros and op not in ("inc", "dec", "jnz"):
+                        callee = escapes[op]
+                        if callee is None:
+                            more = None
+                        else:
+                            args = dict(zip(self.macros[op][0], instr[1:]))
+                            more = set()
+                            for kind, t in callee:
+                                if kind == "name":
+                                    part = (set() if _find_label(labels, t) is not None
+                                        else {(kind, t)})
+                                else:
+                                    part = outside(args[t]) if t in args else None
+                                if part is None:
+                                    more = None
+                                    break
+                                more |= part
+                    else:
+                        continue
+                    if more is None:
+                        found = None
+                        break
+                    found |= more
+                found = None if found is None else frozenset(found)
+                if found != escapes[name]:
+                    escapes[name], changed = found, True
+        return escapes
+
+    def _tail_safe(self, name, mapping, labels):
+        # whether a tail call to macro name (callee map given) can replace the
+        # calling frame: true if no label the callee looks up outside itself is
+        # one of the caller's labels, so dropping the caller changes no jump
+        if self._escapes is None:
+            self._escapes, self._escapes_for = self._label_escapes(), dict(self.macros)
+        escapes = self._escapes.get(name)
+        if escapes is None:
+            return False
+        for kind, t in escapes:
+            if _find_label(labels, mapping.get(t, t) if kind == "param" else t) is not None:
+                return False
+        return True
 
     def _jump(self, target):
-        # current frame
-        idx = self._find_label_in_frame(target, self.stack[-1])
-        if idx is not None:
-            self.stack[-1]["pc"] = idx
-            return
-        # outward search
+        # jump to a caller's label (_step has searched the current frame); returns
+        # the history undo record: (kept depth, removed frames, frame, old pc), or
+        # None with history off, when the removed frames go to the frame pool.
+        # The outward search drops every frame it passes, so their calls pay for it.
         for d in range(len(self.stack) - 2, -1, -1):
-            idx = self._find_label_in_frame(target, self.stack[d])
+            idx = _find_label(self.stack[d].labels, target)
             if idx is not None:
+                undo = None
+                if self.record_history:
+                    undo = (d + 1, self.stack[d + 1:], self.stack[d], self.stack[d].pc)
+                else:
+                    self._frame_pool.extend(self.stack[d + 1:])
                 del self.stack[d + 1 :]
-                self.stack[-1]["pc"] = idx
-                return
+                self.stack[-1].pc = idx
+                return undo
         raise KeyError(f"Label '{target}' not found in any frame")
 
     def _peek_next_instr(self):
         if not self.stack:
             return None
         fr = self.stack[-1]
-        if fr["pc"] >= len(fr["code"]):
+        if fr.pc >= len(fr.code):
             return None
-        return fr["code"][fr["pc"]]
+        return fr.code[fr.pc]
 
-    def _save_snapshot(self, current_instr):
-        # deep snapshot so history is immutable
-        self.history.append({
-            "step": self.step_count,
-            "vars": deepcopy(self.vars),
-            "stack": deepcopy(self.stack),
-            "stack_depth": len(self.stack),
-            "next_instr": deepcopy(current_instr),
-        })
+    def _record(self, var, old, undo):
+        if self.record_history:
+            self.history.append((self.step_count, len(self.stack), self._peek_next_instr(),
+                                 var, old, *undo))
 
     def _validate_inputs(self):
-        for k, v in (self.inputs or {}).items():
-            if not isinstance(v, int) or v < 0:
-                raise ValueError(f"Input {k} must be a non-negative integer, got {v}")
+        _validate_inputs(self.inputs)
+
+
+_MISSING = object()  # history: the variable did not exist before the step
+
+
+class _Frame:
+    """
+    One activation on SMachine.stack. __slots__ keeps it to five fields with
+    no per-instance dict. run() and step() recycle finished frames through
+    SMachine._frame_pool only while history is off: the journal keeps
+    references to popped frames so rewind can restore them.
+    """
+    __slots__ = ("code", "pc", "labels", "map", "ops")
+
+    def __init__(self, code, pc, labels, mapping, ops):
+        self.code, self.pc, self.labels, self.map, self.ops = code, pc, labels, mapping, ops
+
+    def as_dict(self):
+        """
+        The frame in the dict form used by history snapshots and state().
+        The body is shared with every frame of the macro, so the code is the
+        body tuple and labels and map are read-only views; a map is never
+        changed once its call has started.
+        """
+        return {"code": self.code, "pc": self.pc, "labels": MappingProxyType(self.labels),
+                "map": MappingProxyType(self.map)}
+
+
+class _History(Sequence):
+    """
+    SMachine history as an undo journal, one entry per step: (step, depth,
+    next_instr, var, old, kept depth, removed frames, frame, old pc).
+    history[i] rebuilds snapshot i by undoing later entries from the nearest checkpoint.
+    Walks leave one every vm.history_stride snapshots, at most _CHECKPOINTS per pass.
+    """
+
+    def __init__(self, vm):
+        self._vm = vm
+        self._entries = []
+        self._marks = []        # sorted indices of self._checkpoints
+        self._checkpoints = {}  # snapshot index -> (vars copy, [(frame, pc), ...])
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            wanted = range(*idx.indices(len(self)))
+            if not wanted:
+                return []
+            found = {i: self._snapshot(i, vars_, stack)
+                     for i, vars_, stack in self._states(min(wanted), max(wanted)) if i in wanted}
+            return [found[i] for i in wanted]
+        idx = range(len(self._entries))[idx]
+        for i, vars_, stack in self._states(idx, idx):
+            if i == idx:
+                return self._snapshot(i, vars_, stack)
+
+    def __iter__(self):
+        return iter(self[:])
+
+    def __reversed__(self):
+        for i, vars_, stack in self._states(0):
+            yield self._snapshot(i, vars_, stack)
+
+    def _states(self, lo, hi=None):
+        # (i, vars, stack) for snapshots i = hi (default: the last) or above
+        # down to lo, undoing one entry at a time on a single copy of the state:
+        # a slice or a full walk costs one pass instead of one pass per snapshot
+        copies, originals = {}, {}
+
+        def copy(frame):
+            c = copies.get(id(frame))
+            if c is None:
+                c = copies[id(frame)] = _Frame(frame.code, frame.pc, frame.labels, frame.map,
+                                               frame.ops)
+                originals[id(c)] = frame
+            return c
+
+        start = len(self._entries) - 1
+        k = bisect_left(self._marks, start if hi is None else hi)
+        if k < len(self._marks):
+            start = self._marks[k]
+            saved_vars, saved_stack = self._checkpoints[start]
+            vars_ = dict(saved_vars)
+            stack = [copy(f) for f, _ in saved_stack]
+            for c, (_, pc) in zip(stack, saved_stack):
+                c.pc = pc
+        else:
+            vars_ = dict(self._vm.vars)
+            stack = [copy(f) for f in self._vm.stack]
+        stride = self._vm.history_stride
+        stride = stride and max(stride, -(-len(self._entries) // _CHECKPOINTS))
+        for i in range(start, lo - 1, -1):
+            if stride and i % stride == 0 and i not in self._checkpoints:
+                insort(self._marks, i)
+                self._checkpoints[i] = (dict(vars_), [(originals[id(c)], c.pc) for c in stack])
+            yield i, vars_, stack
+            _undo(self._entries[i], vars_, stack, copy)
+
+    def _snapshot(self, i, vars_, stack):
+        step, depth, next_instr = self._entries[i][:3]
+        return {"step": step, "vars": dict(vars_), "stack": [f.as_dict() for f in stack],
+                "stack_depth": depth, "next_instr": next_instr}
+
+    def append(self, entry):
+        self._entries.append(entry)
+
+    def rewind(self, idx):
+        """Undo the live machine back to snapshot idx and drop the later entries."""
+        idx = range(len(self._entries))[idx]
+        vm = self._vm
+        for entry in reversed(self._entries[idx + 1:]):
+            _undo(entry, vm.vars, vm.stack, lambda frame: frame)
+        del self._entries[idx + 1:]
+        vm.step_count = self._entries[idx][0]
+        for i in self._marks[bisect_right(self._marks, idx):]:
+            del self._checkpoints[i]
+        del self._marks[bisect_right(self._marks, idx):]
+
+
+_CHECKPOINTS = 64  # most history checkpoints one walk leaves, see _History
+
+
+def _undo(entry, vars_, stack, frame_of):
+    var, old, keep, removed, frame, old_pc = entry[3:]
+    if var is not None:
+        if old is _MISSING:
+            del vars_[var]
+        else:
+            vars_[var] = old
+    del stack[keep:]
+    stack.extend(frame_of(f) for f in removed)
+    if frame is not None:
+        frame_of(frame).pc = old_pc
+
+
+class _Labels(dict):
+    """A body's label table, label -> pc; lookup also maps each prefix p of a label p__... ."""
+
+    __slots__ = ("lookup",)
+
+    def index_suffixed(self):
+        self.lookup = {}
+        for k, pc in self.items():
+            i = k.find("__")
+            while i >= 0:
+                self.lookup.setdefault(k[:i], pc)
+                i = k.find("__", i + 1)
+        self.lookup.update(self)
+
+
+def _bind_site(site, macro, args):
+    # site is [macro, fixed map, mapped pairs, caller-bound args]: the call's
+    # param -> arg map (last one wins) split into the args that name
+    # themselves and the (param, arg) pairs mapped through the caller's frame.
+    # Rebuilt when the macro is replaced.
+    mapped = site[3]
+    binding = dict(zip(macro[0], args))
+    site[:3] = (macro, {p: a for p, a in binding.items() if a not in mapped},
+                tuple((p, a) for p, a in binding.items() if a in mapped))
+
+
+def _find_label(labels, label):
+    # pc of label in a body's label table: exact name, else a suffixed one
+    return labels.lookup.get(label)
+
+
+def _validate_inputs(inputs):
+    for k, v in (inputs or {}).items():
+        if not isinstance(v, int) or v < 0:
+            raise ValueError(f"Input {k} must be a non-negative integer, got {v}")
+
+
+def _step_limit_error():
+    # raised by every engine once a run reaches max_steps
+    return RuntimeError("Maximum step count exceeded; possible undefined condition")
+
+
+def _builtin_result(name, value):
+    if not isinstance(value, int) or value < 0:
+        raise ValueError(f"Builtin {name} must return a non-negative integer, got {value}")
+    return value
+
+
+def _label_trap(label):
+    # the builtin a jump to a missing label calls: it raises as SMachine._jump does
+    def trap():
+        raise KeyError(f"Label '{label}' not found in any frame")
+    return trap
+
+
+# ---------- bytecode compiler ----------
+#
+# compile_program() inlines non-recursive macros into integer opcodes over
+# variable slots and absolute pcs; recursive macros become callable segments
+# with frame-relative (*_REL) operands.
+
+OP_INC = 0          # inc  slot
+OP_DEC = 1          # dec  slot
+OP_JNZ = 2          # jnz  slot, target_pc
+OP_CLEAR = 3        # zero slots [arg1, arg1 + arg2)
+OP_INC_REL = 4      # as above, arg1 is a frame index
+OP_DEC_REL = 5
+OP_JNZ_REL = 6
+OP_CLEAR_REL = 7
+OP_CALL = 8         # call site arg1 (index into Program.calls)
+OP_RET = 9
+OP_ADD_ABSORB = 10  # every ref in Program.absorbs[arg2] += arg1's value, then arg1 = 0
+OP_NATIVE = 11      # arg1 = index into Program.natives
+OP_JMP = 12         # unconditional jump to arg2
+OP_WATCH = 13       # backward jump checked for a spin; original op in Program.watch
+OP_LOOP = 14        # if arg1's value n: apply Program.loops[arg2] n times at once, then arg1 = 0
+
+_LABEL = -1         # label marker, only present before assembly
+_REL = {OP_INC: OP_INC_REL, OP_DEC: OP_DEC_REL, OP_JNZ: OP_JNZ_REL, OP_CLEAR: OP_CLEAR_REL}
+_PRIMITIVES = {"inc": OP_INC, "dec": OP_DEC, "jnz": OP_JNZ}  # for _step on malformed ones
+
+
+@dataclass
+class Program:
+    """
+    Compiled S program: parallel arrays ops/arg1/arg2 indexed by pc, named
+    variables at `slots`, execution from `entry`. A negative ref ~i is index i
+    of the current frame. Per site: calls (entry, arg refs, frame size),
+    absorbs (target refs), natives (name, fn, out, ins), loops (terms
+    (ref, const, srcs, step_const, step_srcs); see _fuse_loops); watch maps
+    each OP_WATCH pc to its original op.
+    """
+    ops: array
+    arg1: array
+    arg2: array
+    slots: dict
+    n_slots: int
+    entry: int = 0
+    calls: list = field(default_factory=list)
+    frame_width: int = 0
+    absorbs: list = field(default_factory=list)
+    natives: list = field(default_factory=list)
+    watch: dict = field(default_factory=dict)
+    loops: list = field(default_factory=list)
+    threaded: object = field(default=None, init=False, repr=False, compare=False)  # see _interpret
+
+    @property
+    def y_slot(self) -> int:
+        return self.slots["y"]
+
+    def make_vars(self, inputs: dict | None = None) -> list[int]:
+        """Return a zeroed variable array seeded with the given inputs."""
+        _validate_inputs(inputs)
+        vars_ = [0] * self.n_slots
+        for name, value in (inputs or {}).items():
+            slot = self.slots.get(name)
+            if slot is not None:
+                vars_[slot] = value
+        return vars_
+
+    def named_vars(self, vars_: list[int]) -> dict:
+        """Project a variable array back onto the program's named variables."""
+        return {name: vars_[slot] for name, slot in self.slots.items()}
+
+    @cached_property
+    def native_code(self):
+        """
+        The program as flat NumPy arrays for _run_njit, built on first use;
+        OP_ADD_ABSORB k owns targets[offsets[k]:offsets[k + 1]], call site k
+        its arg refs, call_refs[call_offsets[k]:call_offsets[k + 1]], and
+        OP_LOOP k its terms, loop_code[loop_offsets[k]:loop_offsets[k + 1]].
+        """
+        offsets, targets = [0], []
+        for refs in self.absorbs:
+            targets += refs
+            offsets.append(len(targets))
+        call_offsets, call_refs = [0], []
+        for _, refs, _ in self.calls:
+            call_refs += refs
+            call_offsets.append(len(call_refs))
+        loop_offsets, loop_code = [0], []
+        for terms in self.loops:
+            for ref, const, srcs, step_const, step_srcs in terms:
+                loop_code += [ref, const, len(srcs), *(x for pair in srcs for x in pair),
+                              step_const, len(step_srcs), *(x for pair in step_srcs for x in pair)]
+            loop_offsets.append(len(loop_code))
+        return (np.frombuffer(self.ops, dtype=np.uint8),
+                np.frombuffer(self.arg1, dtype=np.int32),
+                np.frombuffer(self.arg2, dtype=np.int32),
+                np.array(offsets, dtype=np.int32), np.array(targets, dtype=np.int32),
+                np.array([entry for entry, _, _ in self.calls], dtype=np.int32),
+                np.array([used for _, _, used in self.calls], dtype=np.int32),
+                np.array(call_offsets, dtype=np.int32), np.array(call_refs, dtype=np.int32),
+                np.array(loop_offsets, dtype=np.int32), np.array(loop_code, dtype=np.int64))
+
+
+class _Compiler:
+    """
+    Single-use macro expander and assembler behind compile_program().
+    Labels are resolved innermost-first through the enclosing macro bodies,
+    which is the same search order SMachine._jump uses at runtime.
+    """
+
+    def __init__(self, macros, builtins=None):
+        self.macros = {}
+        for name, spec in (macros or {}).items():
+            params, body = spec[0], spec[1]
+            locals_ = spec[2] if len(spec) > 2 else []
+            self.macros[name] = (list(params), list(body), list(locals_))
+        self.slots = {}             # global name -> slot
+        self.n_slots = 0
+        self.local_base = {}        # macro name -> first slot of its locals
+        self.code = []              # [op, arg1, arg2] with _LABEL markers
+        self.segments = {}          # recursive macro -> entry label id
+        self.widths = {}            # recursive macro -> frame width
+        self.pending = []           # segments still to be compiled
+        self.calls = []             # (macro name, arg refs)
+        self.width = None           # frame width of the segment being compiled
+        self.segment = None         # the recursive macro being compiled
+        self.absorbs = []           # target refs per OP_ADD_ABSORB
+        self.loops = []             # terms per OP_LOOP, see Program
+        self.builtins = dict(builtins or {})
+        self.natives = []           # (name, fn, out ref, in refs) per OP_NATIVE
+        self.traps = {}             # missing label -> label id of its trap
+        self.expansions = {}        # (macro, arg refs, active) -> closed expansion
+        self.reach = 0              # outermost scope a label lookup has resolved in
+        self.label_defs = {}        # macro name -> label -> index of its definition
+        self._label_ids = count()
+
+    def compile(self, instructions) -> Program:
+        self._global("y")
+        main = self.code = []
+        self._expand(list(instructions), {}, [], ())
+        traps = []  # in front of the main program, which starts past them
+        for label, trap in self.traps.items():
+            self.natives.append((label, _label_trap(label), self.slots["y"], ()))
+            traps += [[_LABEL, trap, 0], [OP_NATIVE, len(self.natives) - 1, 0]]
+        # every slot past the globals is a macro local; main has no aliasing refs
+        scratch = set(range(self.n_slots)) - set(self.slots.values())
+        main = self._fuse(traps + main, scratch, set())
+        self._drop_dead_stores(main, scratch)
+        code = []
+        while self.pending:
+            code += self._segment(self.pending.pop())
+        entry = sum(op != _LABEL for op, _, _ in code) + len(self.traps)
+        return self._assemble(code + main, entry)
+
+    # ---------- slots ----------
+
+    def _global(self, name):
+        slot = self.slots.get(name)
+        if slot is None:
+            slot = self.slots[name] = self.n_slots
+            self.n_slots += 1
+        return slot
+
+    def _var(self, name, env):
+        # unmapped names are globals, exactly like mapping.get(v, v) in step()
+        ref = env.get(name, name)
+        return self._global(ref) if isinstance(ref, str) else ref
+
+    def _locals(self, name, locals_):
+        if self.width is not None:
+            # inside a recursive segment every local lives in the frame
+            base = self.width
+            self.width += len(locals_)
+            return ~base
+        # in the main program a macro is never active twice at once, so all
+        # of its inlined copies share one block of slots (cleared on entry)
+        base = self.local_base.get(name)
+        if base is None:
+            base = self.local_base[name] = self.n_slots
+            self.n_slots += len(locals_)
+        return base
+
+    # ---------- expansion ----------
+
+    def _expand(self, code, env, scopes, active, last=None):
+        if last is None:
+            last = _label_defs(code)
+        labels = {name: next(self._label_ids) for name in last}
+        scopes = scopes + [labels]
+
+        for i, instr in enumerate(code):
+            op, *args = instr
+            if op.endswith(":"):
+                if last[op[:-1]] == i:
+                    self.code.append([_LABEL, labels[op[:-1]], 0])
+            elif op == "inc":
+                self.code.append([OP_INC, self._var(args[0], env), 0])
+            elif op == "dec":
+                self.code.append([OP_DEC, self._var(args[0], env), 0])
+            elif op == "jnz":
+                target = self._label(args[1], env, scopes)
+                self.code.append([OP_JNZ, self._var(args[0], env), target])
+            elif op in self.builtins:
+                if not args:
+                    raise ValueError(f"Builtin {op} needs an output variable")
+                refs = tuple(self._var(a, env) for a in args)
+                self.natives.append((op, self.builtins[op], refs[0], refs[1:]))
+                self.code.append([OP_NATIVE, len(self.natives) - 1, 0])
+            elif op in self.macros:
+                self._inline(op, args, env, scopes, active)
+            else:
+                raise ValueError(f"Unknown instruction {op}")
+
+    def _inline(self, name, args, env, scopes, active):
+        params, body, locals_ = self.macros[name]
+        if len(args) != len(params):
+            raise ValueError(f"Macro {name} expects {len(params)} args, got {len(args)}")
+        if name in active:
+            self._call(name, args, env)
+            return
+        new_env = {p: env.get(a, a) for p, a in zip(params, args)}
+        # in the main program, an expansion that jumps only to its own labels
+        # is reused with fresh label ids; segments always expand
+        key = (name, tuple(new_env.values()), active) if self.width is None else None
+        cached = self.expansions.get(key)
+        if cached is not None:
+            self.code += _relabel(cached, self._label_ids)
+            return
+        start, outer_reach, self.reach = len(self.code), self.reach, len(scopes)
+        if locals_:
+            base = self._locals(name, locals_)
+            step = -1 if base < 0 else 1
+            for i, loc in enumerate(locals_):
+                new_env[loc] = base + step * i
+            self.code.append([OP_CLEAR, base, len(locals_)])
+        self._expand(body, new_env, scopes, active + (name,), self._macro_labels(name))
+        if key is not None and self.reach >= len(scopes):
+            self.expansions[key] = self.code[start:]
+        self.reach = min(outer_reach, self.reach)
+
+    def _macro_labels(self, name):
+        # _label_defs of a macro body, once per compile however often it is inlined
+        last = self.label_defs.get(name)
+        if last is None:
+            last = self.label_defs[name] = _label_defs(self.macros[name][1])
+        return last
+
+    def _call(self, name, args, env):
+        if name not in self.segments:
+            self.segments[name] = next(self._label_ids)
+            self.pending.append(name)
+        refs = tuple(self._var(a, env) for a in args)
+        self.calls.append((name, refs))
+        self.code.append([OP_CALL, len(self.calls) - 1, 0])
+
+    def _segment(self, name):
+        # a recursive macro body, entered through OP_CALL with a fresh frame:
+        # params first, then its own locals, then locals of inlined callees
+        params, body, locals_ = self.macros[name]
+        outer, outer_width, self.segment = self.code, self.width, name
+        self.code = [[_LABEL, self.segments[name], 0]]
+        env = {p: ~i for i, p in enumerate(params)}
+        self.width = len(params)
+        for loc in locals_:
+            env[loc] = ~self.width
+            self.width += 1
+        self._expand(body, env, [], (name,), self._macro_labels(name))
+        self.code.append([OP_RET, 0, 0])
+        self.widths[name] = self.width
+        code, self.code, self.width, self.segment = self.code, outer, outer_width, None
+        # params may alias each other or a global at runtime; locals cannot
+        p = len(params)
+        return self._fuse(code, {~i for i in range(p, self.widths[name])}, {~i for i in range(p)})
+
+    def _label(self, name, env, scopes):
+        target = env.get(name, name)
+        if isinstance(target, str):
+            for depth in range(len(scopes) - 1, -1, -1):
+                if target in scopes[depth]:
+                    self.reach = min(self.reach, depth)
+                    return scopes[depth][target]
+        if self.segment is not None:
+            # a label param or a caller's label: only found at run time, in a
+            # frame the compiled call does not keep
+            params = self.macros[self.segment][0]
+            if not isinstance(target, str) and ~target < len(params):
+                name = params[~target]
+            raise ValueError(f"Label '{name}' leaves recursive macro '{self.segment}'")
+        # no frame has it: as in SMachine, only taking the jump raises
+        self.reach = 0
+        label = target if isinstance(target, str) else name
+        trap = self.traps.get(label)
+        if trap is None:
+            trap = self.traps[label] = next(self._label_ids)
+        return trap
+
+    # ---------- fusion ----------
+
+    def _fuse(self, code, scratch, shared):
+        """
+        Peephole pass over one code buffer: gotos become jmp, zeroing,
+        transfer and counted loops become clear, add_absorb and loop ops, and
+        a jmp to the label right after it is dropped. `scratch` holds refs
+        private to one macro call, `shared` the refs that may alias another
+        ref at runtime.
+        """
+        jumps = _jump_scratch(code, scratch, self.calls, self.absorbs, self.natives)
+        for i, (op, a1, a2) in enumerate(code):
+            if op == OP_JNZ and a1 in jumps:
+                code[i - 1], code[i] = None, [OP_JMP, 0, a2]
+            elif op == OP_CLEAR and a2 == 1 and a1 in jumps:
+                code[i] = None
+        code = [instr for instr in code if instr is not None]
+
+        for i in range(len(code) - 2, -1, -1):
+            op, v, _ = code[i]
+            op2, v2, target = code[i + 1]
+            if op == OP_DEC and op2 == OP_JNZ and v2 == v and target in _labels_before(code, i):
+                code[i:i + 2] = [[OP_CLEAR, v, 1]]
+
+        # one backwards pass; fused loops are blanked to None so indices stay
+        # valid, and a fused op is never part of another loop's body
+        where, uses = {}, {}
+        for i, (op, a1, a2) in enumerate(code):
+            if op == _LABEL:
+                where[a1] = i
+            elif op in (OP_JNZ, OP_JMP):
+                uses[a2] = uses.get(a2, 0) + 1
+        for i in range(len(code) - 1, -1, -1):
+            if code[i] is None or code[i][0] != OP_JNZ:
+                continue
+            _, d, target = code[i]
+            b = where[target]
+            if uses[target] != 1 or b - 1 <= i or code[b - 1] is None or code[b - 1][0] != OP_JMP:
+                continue
+            heads = _labels_before(code, i)
+            g, targets, decs = b + 1, [], 0
+            while g < len(code) and code[g] and code[g][0] in (OP_INC, OP_DEC):
+                if code[g][0] == OP_DEC:
+                    if code[g][1] != d:
+                        break
+                    decs += 1
+                else:
+                    targets.append(code[g][1])
+                g += 1
+            if (g == len(code) or not code[g] or code[g][0] != OP_JMP
+                    or code[g][2] not in heads or decs != 1):
+                continue
+            if any(t == d or (d in shared and t not in scratch)
+                   or (t in shared and d not in scratch) for t in targets):
+                continue
+            if targets:
+                self.absorbs.append(tuple(targets))
+                code[i] = [OP_ADD_ABSORB, d, len(self.absorbs) - 1]
+            else:
+                code[i] = [OP_CLEAR, d, 1]
+            code[b:g + 1] = [None] * (g + 1 - b)
+        code = [instr for instr in code if instr is not None]
+        _drop_jumps_to_next(code)
+        if self._fuse_loops(code, shared):
+            code = [instr for instr in code if instr is not None]
+            _drop_jumps_to_next(code)
+        return code
+
+    def _drop_dead_stores(self, code, scratch):
+        """
+        Remove, in place, writes to scratch slots (the macro locals of the main
+        program) that nothing reads before the slot is cleared again or the
+        program ends. The usual one is the copy that ends a macro, such as
+        equals(y, _y) at the end of add: with _y and equals' own _z dead
+        afterwards it comes down to clear y; add_absorb _y, (y).
+        """
+        bit = {ref: 1 << i for i, ref in enumerate(sorted(scratch))}
+        after = self._live_after(code, bit)
+        for i, (op, a1, a2) in enumerate(code):
+            out = after[i]
+            if op in (OP_INC, OP_DEC) and _dead(a1, bit, out):
+                code[i] = None
+            elif op == OP_CLEAR and all(_dead(r, bit, out) for r in range(a1, a1 + a2)):
+                code[i] = None
+            elif op == OP_ADD_ABSORB:
+                targets = tuple(t for t in self.absorbs[a2] if not _dead(t, bit, out))
+                if targets:
+                    self.absorbs[a2] = targets
+                else:
+                    code[i] = None if _dead(a1, bit, out) else [OP_CLEAR, a1, 1]
+        code[:] = [instr for instr in code if instr is not None]
+        _drop_jumps_to_next(code)
+
+    def _live_after(self, code, bit):
+        # per pc of a code buffer without frame-relative refs, the scratch refs
+        # (as a mask of their bits) whose value may still be read after it
+        # runs; fixpoint over the jumps. A write to a dead ref reads nothing,
+        # so the writes this finds dead can all go at once without leaving
+        # another one dead.
+        def mask(refs):
+            return sum({bit[r] for r in refs if r in bit})
+
+        where = {a1: i for i, (op, a1, _) in enumerate(code) if op == _LABEL}
+        live = [0] * (len(code) + 1)  # before each pc; nothing after the end
+        after = [0] * len(code)
+        changed = True
+        while changed:
+            changed = False
+            for i in range(len(code) - 1, -1, -1):
+                op, a1, a2 = code[i]
+                if op == OP_JMP:
+                    out = live[where[a2]]
+                elif op == OP_JNZ:
+                    out = live[i + 1] | live[where[a2]]
+                else:
+                    out = live[i + 1]
+                after[i] = out
+                if op in (_LABEL, OP_JMP, OP_INC, OP_DEC):
+                    before = out  # inc and dec only read their slot if it is read later
+                elif op == OP_JNZ:
+                    before = out | bit.get(a1, 0)
+                elif op == OP_CLEAR:
+                    before = out & ~mask(range(a1, a1 + a2))
+                elif op == OP_ADD_ABSORB:
+                    # d is zeroed; its value is read only if a target is
+                    before = out & ~bit.get(a1, 0)
+                    if not all(_dead(t, bit, out) for t in self.absorbs[a2]):
+                        before |= bit.get(a1, 0)
+                elif op == OP_NATIVE:
+                    _, _, ref, ins = self.natives[a1]
+                    before = out & ~bit.get(ref, 0) | mask(ins)
+                elif op == OP_CALL:
+                    before = out | mask(self.calls[a1][1])
+                elif op == OP_LOOP:
+                    terms = self.loops[a2]
+                    before = out | bit.get(a1, 0) | mask(
+                        r for ref, _, srcs, _, step_srcs in terms
+                        for r in (ref, *(src for src, _ in srcs + step_srcs)))
+                else:
+                    before = out | mask(bit)
+                if before != live[i]:
+                    live[i], changed = before, True
+        return after
+
+    def _fuse_loops(self, code, shared):
+        """
+        Fuse, in place, each counted loop H: jnz d, B; <exit>; B: body; jmp H
+        whose body is straight-line incs, clears and absorbs with one dec d and
+        no other use of d, such as the outer loop of mul once its transfers are
+        fused. Those ops are linear, so a pass leaves each ref it changes at a
+        fixed sum over the values at its start. The loop qualifies when every
+        changed ref either grows, v + L with L over refs the pass leaves
+        alone, or is set, to L over such refs and growing ones; and no ref it
+        touches may alias. After n passes a growing ref has gained n * L and a
+        set ref reads the growing ones as they were before the last pass (see
+        Program.loops). Returns whether any loop was fused (blanked to None
+        like the absorbs above).
+        """
+        where, uses = {}, {}
+        for i, (op, a1, a2) in enumerate(code):
+            if op == _LABEL:
+                where[a1] = i
+            elif op in (OP_JNZ, OP_JMP):
+                uses[a2] = uses.get(a2, 0) + 1
+        fused = False
+        for i in range(len(code) - 1, -1, -1):
+            if code[i] is None or code[i][0] != OP_JNZ:
+                continue
+            _, d, target = code[i]
+            b = where[target]
+            if uses[target] != 1 or b - 1 <= i or code[b - 1] is None or code[b - 1][0] != OP_JMP:
+                continue
+            # forms[r]: value of r after the body so far, as {src: coef}
+            # over the values at the start of the pass; None keys a constant
+            forms, touched, decs, g = {}, set(), 0, b + 1
+            while g < len(code):
+                if code[g] is None:
+                    g += 1
+                    continue
+                op, a1, a2 = code[g]
+                if op == _LABEL and a1 not in uses:
+                    pass
+                elif op == OP_DEC and a1 == d:
+                    decs += 1
+                elif op == OP_INC and a1 != d:
+                    forms[a1] = _form_add(forms.get(a1, {a1: 1}), {None: 1})
+                    touched.add(a1)
+                elif op == OP_CLEAR and d not in _clear_refs(a1, a2):
+                    for r in _clear_refs(a1, a2):
+                        forms[r] = {}
+                        touched.add(r)
+                elif op == OP_ADD_ABSORB and d != a1 and d not in self.absorbs[a2]:
+                    amount = forms.get(a1, {a1: 1})
+                    for t in self.absorbs[a2]:
+                        forms[t] = _form_add(forms.get(t, {t: 1}), amount)
+                    forms[a1] = {}
+                    touched.update((a1, *self.absorbs[a2]))
+                else:
+                    break
+                g += 1
+            if (g == len(code) or code[g][0] != OP_JMP or code[g][2] not in _labels_before(code, i)
+                    or decs != 1 or (touched | {d}) & shared):
+                continue
+            changed = {r: f for r, f in forms.items() if f != {r: 1}}
+            # per pass gain of each growing ref, then of each set one
+            gain = {r: _form_add(f, {r: -1}) for r, f in changed.items() if r in f}
+            if any(f[r] != 1 or changed.keys() & gain[r].keys()
+                   for r, f in changed.items() if r in gain):
+                continue
+            terms = []
+            for r, f in changed.items():
+                if r not in gain:
+                    if any(src in changed and src not in gain for src in f):
+                        break
+                    step = {}
+                    for src, coef in f.items():
+                        if src in gain:
+                            step = _form_add(step, {s: coef * c for s, c in gain[src].items()})
+                    terms.append(_loop_term(r, f, step))
+            else:
+                terms += [_loop_term(r, changed[r], gain[r]) for r in gain]
+                if terms:
+                    self.loops.append(tuple(terms))
+                    code[i] = [OP_LOOP, d, len(self.loops) - 1]
+                else:
+                    code[i] = [OP_CLEAR, d, 1]
+                code[b:g + 1] = [None] * (g + 1 - b)
+                fused = True
+        return fused
+
+    # ---------- assembly ----------
+
+    def _assemble(self, code, entry) -> Program:
+        label_pc, pc = {}, 0
+        for op, a1, _ in code:
+            if op == _LABEL:
+                label_pc[a1] = pc
+            else:
+                pc += 1
+        ops, arg1, arg2 = array("B"), array("i"), array("i")
+        for op, a1, a2 in code:
+            if op == _LABEL:
+                continue
+            if op in _REL and a1 < 0:
+                op, a1 = _REL[op], ~a1
+            ops.append(op)
+            arg1.append(a1)
+            arg2.append(label_pc[a2] if op in (OP_JNZ, OP_JNZ_REL, OP_JMP) else a2)
+        calls = [(label_pc[self.segments[name]], refs, self.widths[name])
+                 for name, refs in self.calls]
+        width = max(self.widths.values(), default=0)
+        return Program(ops, arg1, arg2, dict(self.slots), self.n_slots, entry, calls, width,
+                       self.absorbs, self.natives, loops=self.loops)
+
+
+def _relabel(code, label_ids):
+    # copy of an expansion with fresh ids for the labels it defines
+    fresh = {a1: next(label_ids) for op, a1, _ in code if op == _LABEL}
+    return [[op, fresh[a1], a2] if op == _LABEL
+            else [op, a1, fresh.get(a2, a2) if op == OP_JNZ else a2] for op, a1, a2 in code]
+
+
+def _label_defs(code):
+    # label -> index of its definition in a body; the last definition wins
+    last = {}
+    for i, instr in enumerate(code):
+        if instr[0].endswith(":"):
+            last[instr[0][:-1]] = i
+    return last
+
+
+def _labels_before(code, i):
+    # ids of the labels sitting directly in front of code[i]
+    labels = set()
+    while i > 0 and code[i - 1][0] == _LABEL:
+        i -= 1
+        labels.add(code[i][1])
+    return labels
+
+
+def _form_add(a, b):
+    # sum of two linear forms {src: coef} (see _Compiler._fuse_loops)
+    total = dict(a)
+    for src, coef in b.items():
+        total[src] = total.get(src, 0) + coef
+        if not total[src]:
+            del total[src]
+    return total
+
+
+def _loop_term(ref, form, step):
+    # (ref, const, srcs, step_const, step_srcs) of Program.loops
+    def split(f):
+        return f.get(None, 0), tuple((src, coef) for src, coef in f.items() if src is not None)
+    return (ref, *split(form), *split(step))
+
+
+def _dead(ref, bit, live):
+    # whether ref is a scratch ref missing from the live mask (see _Compiler._live_after)
+    return ref in bit and not bit[ref] & live
+
+
+def _drop_jumps_to_next(code):
+    # removes, in place, each jmp to a label directly after it; backwards, so
+    # that a run of such jumps goes as a whole
+    for i in range(len(code) - 1, -1, -1):
+        if code[i][0] == OP_JMP and code[i][2] in _labels_after(code, i):
+            del code[i]
+
+
+def _labels_after(code, i):
+    # ids of the labels sitting directly after code[i]
+    labels = set()
+    while i + 1 < len(code) and code[i + 1][0] == _LABEL:
+        i += 1
+        labels.add(code[i][1])
+    return labels
+
+
+def _clear_refs(base, n):
+    # refs covered by a clear; frame-relative blocks count downwards (~i)
+    return [base + j for j in range(n)] if base >= 0 else [base - j for j in range(n)]
+
+
+def _jump_scratch(code, scratch, calls, absorbs, natives):
+    """
+    Scratch refs whose every read is a `inc z; jnz z, L` pair, such as the
+    local of the inlined goto macro. Such a jnz always jumps and the value of
+    z is never observed, so each pair is an unconditional jump.
+    """
+    uses, pairs = {}, {}
+    for i, (op, a1, a2) in enumerate(code):
+        if op in (OP_INC, OP_DEC, OP_JNZ):
+            refs = [a1]
+        elif op == OP_ADD_ABSORB:
+            refs = [a1, *absorbs[a2]]
+        elif op == OP_CALL:
+            refs = calls[a1][1]
+        elif op == OP_NATIVE:
+            refs = [natives[a1][2], *natives[a1][3]]
+        else:
+            continue  # labels, and clears (which only write)
+        for ref in refs:
+            uses[ref] = uses.get(ref, 0) + 1
+        if op == OP_JNZ and i and code[i - 1][:2] == [OP_INC, a1]:
+            pairs[a1] = pairs.get(a1, 0) + 1
+    return {z for z, n in pairs.items() if z in scratch and uses[z] == 2 * n}
+
+
+def compile_program(instructions: list[tuple], macros: dict | None = None,
+                    builtins: dict | None = None) -> Program:
+    """
+    Compile a program (list of instruction tuples) and its macros into a Program.
+    Calls to a name in `builtins` (see SMachine.register_builtin) compile to a
+    single OP_NATIVE and take precedence over a macro of the same name.
+    Raises ValueError for unknown instructions, bad arity and jumps out of a
+    recursive macro into its caller; a jump to a missing label raises
+    KeyError once taken, as in SMachine.
+    """
+    return _Compiler(macros, builtins).compile(instructions)
+
+
+def _execute(program: Program, vars_: list[int], max_steps: int) -> int:
+    """
+    Run compiled bytecode over vars_ in place; return the number of steps taken.
+    Programs without watched jumps run on the Numba loop when it is installed,
+    with builtin calls made from Python one step each. An op or builtin that
+    would push a value past _NJIT_LIMIT hands the run back to _interpret() at
+    that pc. vars_ keeps its length: the frame pool of recursive calls is dropped.
+    """
+    size = len(vars_)
+    if (_run_njit is not None and not program.watch
+            and max(vars_, default=0) < _NJIT_LIMIT and max_steps < _NJIT_LIMIT):
+        steps = _execute_native(program, vars_, max_steps)
+    else:
+        steps = _interpret(program, vars_, max_steps)
+    del vars_[size:]
+    return steps
+
+
+def _execute_native(program: Program, vars_: list[int], max_steps: int) -> int:
+    # _execute() on _run_njit, with _interpret()'s frame pool preallocated
+    # for 64 depths and doubled whenever a call reaches the end; a program
+    # without calls only uses depth 0 and gets the shared empty pool
+    width, size, cap = program.frame_width, len(vars_), 64
+    if program.calls:
+        bases = np.array([0] + [size + d * width for d in range(cap - 1)], dtype=np.int64)
+        frames = bases[:, None] + np.arange(width, dtype=np.int64)
+        native = np.zeros(size + (cap - 1) * width, dtype=np.int64)
+        native[:size] = vars_
+        rets, bound = np.zeros(cap, dtype=np.int64), np.zeros(cap, dtype=np.int64)
+    else:
+        frames, bases, rets, bound = _NO_CALLS
+        native = np.array(vars_, dtype=np.int64)
+    n, depth, pc, steps, result = len(program.ops), 0, program.entry, 0, None
+    while True:
+        pc, steps, depth = _run_njit(*program.native_code, native, frames, bases, rets, bound,
+                                     depth, pc, steps, max_steps)
+        if pc >= n or steps >= max_steps:
+            break
+        if program.ops[pc] == OP_NATIVE:
+            name, fn, out, ins = program.natives[program.arg1[pc]]
+            row = frames[depth]
+            value = _builtin_result(name, fn(*(int(native[r if r >= 0 else row[~r]]) for r in ins)))
+            out = int(out if out >= 0 else row[~out])
+            pc, steps = pc + 1, steps + 1
+            if value >= _NJIT_LIMIT:
+                result = out, value
+                break
+            native[out] = value
+            continue
+        if program.ops[pc] != OP_CALL:
+            break
+        more = size + np.arange(cap - 1, 2 * cap - 1, dtype=np.int64) * width
+        bases = np.concatenate((bases, more))
+        frames = np.concatenate((frames, more[:, None] + np.arange(width, dtype=np.int64)))
+        native = np.concatenate((native, np.zeros(cap * width, dtype=np.int64)))
+        rets = np.concatenate((rets, np.zeros(cap, dtype=np.int64)))
+        bound = np.concatenate((bound, np.zeros(cap, dtype=np.int64)))
+        cap *= 2
+    if result is not None or pc < n and steps < max_steps:
+        # a transfer or builtin would overflow int64: finish in Python with the same frames
+        vars_[:] = native.tolist()
+        if result is not None:
+            vars_[result[0]] = result[1]
+        state = ([[]] + frames[1:].tolist(), bases.tolist(), rets.tolist(), bound.tolist(),
+                 int(depth))
+        return _interpret(program, vars_, max_steps, int(pc), int(steps), state)
+    vars_[:] = native[:size].tolist()  # the program's own slots; the pool is scratch
+    return int(steps)
+
+
+def _interpret(program: Program, vars_: list[int], max_steps: int,
+               pc: int | None = None, steps: int = 0, state: tuple | None = None) -> int:
+    """
+    Pure-Python run loop behind _execute(); handles every opcode. A run can
+    resume at pc with its frame pool state (frames, bases, rets, bound, depth).
+    """
+    # the program's threaded code is built once and taken while it runs, so
+    # a nested run of the same program (from a builtin) builds its own
+    run, program.threaded = program.threaded or _thread(program), None
+    try:
+        return run(vars_, max_steps, program.entry if pc is None else pc, steps,
+                   state or ([[]], [0], [0], [0], 0))
+    finally:
+        program.threaded = run
+
+
+def _thread(program: Program):
+    # _interpret()'s run loop over threaded code for program. The closures
+    # reach the run's variables and frame pool through the cells below,
+    # which each run rebinds, so the code is reused across runs.
+    ops, arg1, arg2, calls = program.ops, program.arg1, program.arg2, program.calls
+    absorbs, natives, width = program.absorbs, program.natives, program.frame_width
+    loops = program.loops
+
+    # frame pool by call depth: frames[d] maps frame indices to slots, params
+    # pointing at the caller's; bound[d] counts the entries last rebound
+    vars_ = frames = bases = rets = bound = frame = None
+    depth = 0
+
+    # handlers for the ops thread() does not specialize, indexed by opcode:
+    # each takes its pc and returns the next one
+    def clear(pc):
+        base = arg1[pc]
+        vars_[base:base + arg2[pc]] = [0] * arg2[pc]
+        return pc + 1
+
+    def clear_rel(pc):
+        base = frame[arg1[pc]]
+        vars_[base:base + arg2[pc]] = [0] * arg2[pc]
+        return pc + 1
+
+    def call(pc):
+        nonlocal depth, frame
+        entry, refs, used = calls[arg1[pc]]
+        depth += 1
+        if depth == len(frames):
+            base = len(vars_)
+            vars_.extend([0] * width)
+            frames.append(list(range(base, base + width)))
+            bases.append(base)
+            rets.append(0)
+            bound.append(0)
+        callee, base = frames[depth], bases[depth]
+        p = len(refs)
+        for i, ref in enumerate(refs):
+            callee[i] = ref if ref >= 0 else frame[~ref]
+        for i in range(p, bound[depth]):
+            callee[i] = base + i
+        bound[depth] = p
+        vars_[base + p:base + used] = [0] * (used - p)
+        rets[depth] = pc + 1
+        frame = callee
+        return entry
+
+    def ret(pc):
+        nonlocal depth, frame
+        pc = rets[depth]
+        depth -= 1
+        frame = frames[depth]
+        return pc
+
+    def add_absorb(pc):
+        # fused `while d: dec d; inc t...`, with frame-relative refs resolved
+        d = arg1[pc] if arg1[pc] >= 0 else frame[~arg1[pc]]
+        n = vars_[d]
+        if n:
+            for t in absorbs[arg2[pc]]:
+                vars_[t if t >= 0 else frame[~t]] += n
+            vars_[d] = 0
+        return pc + 1
+
+    def loop(pc):
+        # fused counted loop: all of its passes at once (see Program.loops);
+        # a term only reads refs written by later terms, so they apply in order
+        d = arg1[pc] if arg1[pc] >= 0 else frame[~arg1[pc]]
+        n = vars_[d]
+        if n:
+            for t, const, srcs, step_const, step_srcs in loops[arg2[pc]]:
+                value = const + sum(coef * vars_[s if s >= 0 else frame[~s]] for s, coef in srcs)
+                if n > 1:
+                    value += (n - 1) * (step_const + sum(coef * vars_[s if s >= 0 else frame[~s]]
+                                                         for s, coef in step_srcs))
+                vars_[t if t >= 0 else frame[~t]] = value
+            vars_[d] = 0
+        return pc + 1
+
+    def native(pc):
+        name, fn, out, ins = natives[arg1[pc]]
+        values = [vars_[r if r >= 0 else frame[~r]] for r in ins]
+        vars_[out if out >= 0 else frame[~out]] = _builtin_result(name, fn(*values))
+        return pc + 1
+
+    def jump(op, pc):
+        # next pc of a pure jump (jmp/jnz/jnz_rel) under the current variables
+        if op == OP_JMP:
+            return arg2[pc]
+        v = arg1[pc] if op == OP_JNZ else frame[arg1[pc]]
+        return arg2[pc] if vars_[v] else pc + 1
+
+    def watch(pc):
+        # taking a backward jump: while only jumps run no variable changes,
+        # so if they lead back here the program can never leave
+        nxt = jump(program.watch[pc], pc)
+        cur, seen = nxt, set()
+        while cur not in seen and cur < n:
+            if cur == pc:
+                raise RuntimeError(f"Infinite loop: the jumps at pcs {sorted(seen | {pc})} cycle "
+                                   f"without changing any variable")
+            op = program.watch.get(cur, ops[cur])
+            if op not in (OP_JMP, OP_JNZ, OP_JNZ_REL):
+                break
+            seen.add(cur)
+            cur = jump(op, cur)
+        return nxt
+
+    H = [None, None, None, clear, None, None, None, clear_rel, call, ret, add_absorb, native, None,
+         watch, loop]
+
+    def thread(pc):
+        # the op at pc as a closure over its operands that runs it and returns
+        # the next pc; primitives and jmp are specialized, the rest call H
+        op, a, b, nxt = ops[pc], arg1[pc], arg2[pc], pc + 1
+        if op == OP_INC:
+            def run():
+                vars_[a] += 1
+                return nxt
+        elif op == OP_DEC:
+            def run():
+                x = vars_[a]
+                if x:
+                    vars_[a] = x - 1
+                return nxt
+        elif op == OP_JNZ:
+            def run():
+                return b if vars_[a] else nxt
+        elif op == OP_JMP:
+            def run():
+                return b
+        elif op == OP_INC_REL:
+            def run():
+                vars_[frame[a]] += 1
+                return nxt
+        elif op == OP_DEC_REL:
+            def run():
+                v = frame[a]
+                x = vars_[v]
+                if x:
+                    vars_[v] = x - 1
+                return nxt
+        elif op == OP_JNZ_REL:
+            def run():
+                return b if vars_[frame[a]] else nxt
+        else:
+            run = partial(H[op], pc)
+        return run
+
+    n = len(ops)
+    code = [thread(i) for i in range(n)]
+
+    def run(regs, max_steps, pc, steps, state):
+        nonlocal vars_, frames, bases, rets, bound, depth, frame
+        vars_, (frames, bases, rets, bound, depth) = regs, state
+        frame = frames[depth]
+        try:
+            while pc < n and steps < max_steps:
+                pc = code[pc]()
+                steps += 1
+            return steps
+        finally:
+            vars_ = frames = frame = None  # don't keep the run's lists alive
+
+    return run
+
+
+_NJIT_LIMIT = 2 ** 61
+# frames, bases, rets and bound of _execute_native() for programs without calls
+_NO_CALLS = None if np is None else (np.zeros((1, 0), dtype=np.int64), np.zeros(1, dtype=np.int64),
+                                     np.zeros(1, dtype=np.int64), np.zeros(1, dtype=np.int64))
+
+if njit is not None:
+    @njit(cache=True, boundscheck=False)
+    def _run_njit(ops, arg1, arg2, offsets, targets, call_entry, call_used, call_offsets, call_refs,
+                  loop_offsets, loop_code, vars_, frames, bases, rets, bound, depth, pc, steps,
+                  max_steps):
+        # _interpret() over Program.native_code and int64 arrays; returns
+        # (pc, steps, depth) early for a full pool, a builtin or an overflow
+        n = len(ops)
+        while pc < n and steps < max_steps:
+            op = ops[pc]
+            if op == OP_JNZ:
+                pc = arg2[pc] if vars_[arg1[pc]] != 0 else pc + 1
+            elif op == OP_JMP:
+                pc = arg2[pc]
+            elif op == OP_INC:
+                vars_[arg1[pc]] += 1
+                pc += 1
+            elif op == OP_DEC:
+                v = arg1[pc]
+                if vars_[v] != 0:
+                    vars_[v] -= 1
+                pc += 1
+            elif op == OP_JNZ_REL:
+                pc = arg2[pc] if vars_[frames[depth, arg1[pc]]] != 0 else pc + 1
+            elif op == OP_INC_REL:
+                vars_[frames[depth, arg1[pc]]] += 1
+                pc += 1
+            elif op == OP_DEC_REL:
+                v = frames[depth, arg1[pc]]
+                if vars_[v] != 0:
+                    vars_[v] -= 1
+                pc += 1
+            elif op == OP_CALL:
+                if depth + 1 == len(frames):
+                    return pc, steps, depth
+                k = arg1[pc]
+                depth += 1
+                base = bases[depth]
+                p = call_offsets[k + 1] - call_offsets[k]
+                for i in range(p):
+                    ref = call_refs[call_offsets[k] + i]
+                    frames[depth, i] = ref if ref >= 0 else frames[depth - 1, ~ref]
+                for i in range(p, bound[depth]):
+                    frames[depth, i] = base + i
+                bound[depth] = p
+                for v in range(base + p, base + call_used[k]):
+                    vars_[v] = 0
+                rets[depth] = pc + 1
+                pc = call_entry[k]
+            elif op == OP_RET:
+                pc = rets[depth]
+                depth -= 1
+            elif op == OP_NATIVE:
+                return pc, steps, depth  # the caller runs the builtin
+            elif op == OP_CLEAR or op == OP_CLEAR_REL:
+                base = arg1[pc] if op == OP_CLEAR else frames[depth, arg1[pc]]
+                for v in range(base, base + arg2[pc]):
+                    vars_[v] = 0
+                pc += 1
+            elif op == OP_LOOP:
+                d = arg1[pc] if arg1[pc] >= 0 else frames[depth, ~arg1[pc]]
+                k = arg2[pc]
+                amount = vars_[d]
+                if amount != 0:
+                    # the first round only checks for overflow, the second
+                    # writes; a term only reads refs written by later terms,
+                    # so both rounds see the same values
+                    for write in range(2):
+                        j = loop_offsets[k]
+                        while j < loop_offsets[k + 1]:
+                            t = loop_code[j] if loop_code[j] >= 0 else frames[depth, ~loop_code[j]]
+                            j += 1
+                            value = 0
+                            for part in range(2):
+                                # part 0: the one-pass form; part 1: the gain of each later pass
+                                total, m = loop_code[j], loop_code[j + 1]
+                                for q in range(j + 2, j + 2 + 2 * m, 2):
+                                    src = loop_code[q]
+                                    if src < 0:
+                                        src = frames[depth, ~src]
+                                    x = vars_[src]
+                                    if x != 0 and loop_code[q + 1] > (_NJIT_LIMIT - 1 - total) // x:
+                                        return pc, steps, depth
+                                    total += loop_code[q + 1] * x
+                                if part == 0:
+                                    value = total
+                                elif total != 0:
+                                    if amount - 1 > (_NJIT_LIMIT - 1 - value) // total:
+                                        return pc, steps, depth
+                                    value += (amount - 1) * total
+                                j += 2 + 2 * m
+                            if write == 1:
+                                vars_[t] = value
+                    vars_[d] = 0
+                pc += 1
+            else:  # OP_ADD_ABSORB
+                d = arg1[pc] if arg1[pc] >= 0 else frames[depth, ~arg1[pc]]
+                k = arg2[pc]
+                amount = vars_[d]
+                if amount != 0:
+                    # a target listed m times gains m * amount; bound by the list length
+                    m = offsets[k + 1] - offsets[k]
+                    if amount >= _NJIT_LIMIT // m:
+                        return pc, steps, depth
+                    for j in range(offsets[k], offsets[k + 1]):
+                        t = targets[j] if targets[j] >= 0 else frames[depth, ~targets[j]]
+                        if vars_[t] >= _NJIT_LIMIT - amount * m:
+                            return pc, steps, depth
+                    for j in range(offsets[k], offsets[k + 1]):
+                        t = targets[j] if targets[j] >= 0 else frames[depth, ~targets[j]]
+                        vars_[t] += amount
+                    vars_[d] = 0
+                pc += 1
+            steps += 1
+        return pc, steps, depth
+else:
+    _run_njit = None
+
+
+def jit(program: Program):
+    """
+    Generate Python source for a compiled program, one function per basic
+    block, and return f(inputs=None, max_steps=100_000) -> y, as run_program.
+    """
+    if program.calls or program.watch:
+        blocks = sizes = None
+    else:
+        blocks, sizes = _jit_blocks(program.ops.tobytes(), program.arg1.tobytes(),
+                                    program.arg2.tobytes(), tuple(program.absorbs),
+                                    tuple(program.natives), tuple(program.loops))
+
+    def run(inputs: dict | None = None, max_steps=100_000):
+        vars_ = program.make_vars(inputs)
+        if blocks is None:
+            steps = _execute(program, vars_, max_steps)
+        else:
+            pc, steps = _run_blocks(blocks, sizes, vars_, program.entry, max_steps)
+            if pc < len(sizes) and steps < max_steps:
+                # the next block would overrun max_steps: finish op by op
+                steps = _interpret(program, vars_, max_steps, pc, steps)
+        if steps >= max_steps:
+            raise _step_limit_error()
+        return vars_[program.y_slot]
+
+    return run
+
+
+@lru_cache(maxsize=64)
+def _jit_blocks(ops_bytes, arg1_bytes, arg2_bytes, absorbs, natives, loops):
+    # (blocks, sizes) indexed by pc: blocks[pc] runs the basic block starting
+    # at pc over the variable array and returns the next pc; sizes[pc] is its
+    # op count. Only block starts have entries.
+    ops, arg1, arg2 = array("B"), array("i"), array("i")
+    ops.frombytes(ops_bytes)
+    arg1.frombytes(arg1_bytes)
+    arg2.frombytes(arg2_bytes)
+    n = len(ops)
+    leaders = {0}
+    for pc, op in enumerate(ops):
+        if op in (OP_JNZ, OP_JMP):
+            leaders.update((arg2[pc], pc + 1))
+    starts = sorted(pc for pc in leaders if pc < n)
+
+    src, sizes = [], [0] * n
+    for start, end in zip(starts, starts[1:] + [n]):
+        body = []
+        pc = start
+        while pc < end:
+            op, a, b = ops[pc], arg1[pc], arg2[pc]
+            k = 1  # a run of k inc (or dec) of one slot becomes one statement
+            if op in (OP_INC, OP_DEC):
+                while pc + k < end and ops[pc + k] == op and arg1[pc + k] == a:
+                    k += 1
+            if op == OP_INC:
+                body.append(f"v[{a}] += {k}")
+            elif op == OP_DEC:
+                body.append(f"t = v[{a}]\n    v[{a}] = t - {k} if t > {k} else 0" if k > 1
+                            else f"t = v[{a}]\n    if t: v[{a}] = t - 1")
+            elif op == OP_CLEAR:
+                body.append(f"v[{a}] = 0" if b == 1 else f"v[{a}:{a + b}] = [0] * {b}")
+            elif op == OP_ADD_ABSORB:
+                adds = "; ".join(f"v[{t}] += t" for t in absorbs[b])
+                body.append(f"t = v[{a}]\n    if t: {adds}; v[{a}] = 0")
+            elif op == OP_LOOP:
+                terms = []
+                for ref, const, srcs, step_const, step_srcs in loops[b]:
+                    value = " + ".join([f"{const}"] + [f"{coef} * v[{src}]" for src, coef in srcs])
+                    step = " + ".join([f"{step_const}"]
+                                      + [f"{coef} * v[{src}]" for src, coef in step_srcs])
+                    terms.append(f"v[{ref}] = {value} + (t - 1) * ({step})")
+                body.append(f"t = v[{a}]\n    if t: {'; '.join(terms)}; v[{a}] = 0")
+            elif op == OP_NATIVE:
+                _, _, out, ins = natives[a]
+                values = ", ".join(f"v[{r}]" for r in ins)
+                body.append(f"v[{out}] = _builtin_result(N[{a}][0], N[{a}][1]({values}))")
+            elif op == OP_JNZ:
+                body.append(f"return {b} if v[{a}] else {pc + 1}")
+            elif op == OP_JMP:
+                body.append(f"return {b}")
+            else:
+                raise ValueError(f"jit() cannot compile opcode {op}")
+            pc += k
+        if ops[end - 1] not in (OP_JNZ, OP_JMP):
+            body.append(f"return {end}")
+        src.append(f"def _b{start}(v):\n    " + "\n    ".join(body))
+        sizes[start] = end - start
+
+    namespace = {"N": natives, "_builtin_result": _builtin_result}
+    exec(compile("\n\n".join(src), "<s-jit>", "exec"), namespace)
+    blocks = [None] * n
+    for start in starts:
+        blocks[start] = namespace[f"_b{start}"]
+    return blocks, sizes
+
+
+def _run_blocks(blocks, sizes, vars_, pc, max_steps):
+    # stops early, without running it, at a block that would overrun max_steps
+    n, steps = len(sizes), 0
+    while pc < n:
+        k = sizes[pc]
+        if steps + k > max_steps:
+            break
+        steps += k
+        pc = blocks[pc](vars_)
+    return pc, steps
+
+
+def _reads_slot(program: Program, slot: int) -> bool:
+    # whether slot's value at entry can matter: an op reachable from the entry
+    # before slot is zeroed or set reads it (inc and dec do), as does the end
+    # of the program. Recursive calls are followed as far as their absolute
+    # operands; unknown ops count as reads.
+    ops, arg1, arg2 = program.ops, program.arg1, program.arg2
+    seen, todo = set(), [(program.entry, False)]
+    while todo:
+        pc, inner = todo.pop()
+        if pc >= len(ops) and not inner:
+            return True
+        if (pc, inner) in seen or pc >= len(ops):
+            continue
+        seen.add((pc, inner))
+        op, a, b = ops[pc], arg1[pc], arg2[pc]
+        if op in (OP_INC, OP_DEC, OP_JNZ):
+            if a == slot:
+                return True
+        elif op == OP_CLEAR:
+            if a <= slot < a + b and not inner:
+                continue
+        elif op == OP_ADD_ABSORB:
+            if a == slot or slot in program.absorbs[b]:
+                return True
+        elif op == OP_NATIVE:
+            _, _, out, ins = program.natives[a]
+            if slot in ins:
+                return True
+            if out == slot and not inner:
+                continue
+        elif op == OP_CALL:
+            entry, refs, _ = program.calls[a]
+            if slot in refs:
+                return True
+            todo.append((entry, True))
+        elif op == OP_LOOP:
+            # no pass leaves every term as it was, so terms are read too
+            if a == slot or any(slot == t or slot in dict(srcs) or slot in dict(step_srcs)
+                                for t, _, srcs, _, step_srcs in program.loops[b]):
+                return True
+        elif op == OP_RET:
+            continue
+        elif op not in (OP_INC_REL, OP_DEC_REL, OP_JNZ_REL, OP_CLEAR_REL, OP_JMP):
+            return True
+        if op in (OP_JNZ, OP_JNZ_REL, OP_JMP):
+            todo.append((b, inner))
+        if op != OP_JMP:
+            todo.append((pc + 1, inner))
+    return False
+
+
+def watch_spins(program: Program) -> Program:
+    """
+    Replace, in place, every backward jump that can close a loop made only of
+    jumps with OP_WATCH, so a run raises RuntimeError("Infinite loop: ...") as
+    soon as it is stuck in one (e.g. subtract with x2 > x1).
+    """
+    pure = (OP_JMP, OP_JNZ, OP_JNZ_REL)
+    for pc, op in enumerate(program.ops):
+        target = program.arg2[pc]
+        if op in pure and target <= pc and program.ops[target] in pure + (OP_WATCH,):
+            program.watch[pc] = op
+    for pc in program.watch:
+        program.ops[pc] = OP_WATCH
+    program.threaded = None
+    return program
+
+
+def check_program(instructions: list[tuple], inputs: dict | None = None, macros: dict | None = None,
+                  max_steps=100_000, builtins: dict | None = None) -> str | None:
+    """
+    Run a program on the given inputs looking for a loop it can never leave.
+    Return a description of the loop, or None if the program halted or
+    reached max_steps without entering one (which proves nothing).
+    """
+    program = watch_spins(compile_program(instructions, macros, builtins))
+    try:
+        _execute(program, program.make_vars(inputs), max_steps)
+    except RuntimeError as e:
+        return str(e)
+    return None
+
+
+def run_program(instructions: list[tuple], inputs: dict | None = None, macros: dict | None = None,
+                max_steps=100_000, builtins: dict | None = None, validate=False, memo=False):
+    """
+    Compile and run a program to completion; return y.
+    validate=True watches for loops of bare jumps (see watch_spins) and
+    raises as soon as the program is stuck in one.
+    The bytecode is cached per program content; memo=True also caches the
+    result per program content and input.
+    """
+    if memo and not validate:
+        steps, named = _run_memo(instructions, inputs, macros, builtins, max_steps)
+        if steps >= max_steps:
+            raise _step_limit_error()
+        return named["y"]
+    if validate:  # watch_spins() changes the program, so it gets its own
+        program = watch_spins(compile_program(instructions, macros, builtins))
+    else:
+        program = _compiled(instructions, macros, builtins)
+    vars_ = program.make_vars(inputs)
+    if _execute(program, vars_, max_steps) >= max_steps:
+        raise _step_limit_error()
+    return vars_[program.y_slot]
+
+
+def _program_key(instructions, macros, builtins):
+    """Hashable key of a program by content; TypeError if some part is unhashable."""
+    key = (tuple(map(tuple, instructions)),
+           tuple(sorted((name, tuple(spec[0]), tuple(map(tuple, spec[1])),
+                         tuple(spec[2]) if len(spec) > 2 else ())
+                        for name, spec in (macros or {}).items())),
+           tuple(sorted((builtins or {}).items(), key=lambda item: item[0])))
+    hash(key)
+    return key
+
+
+def _compiled(instructions, macros, builtins):
+    """compile_program() through the bytecode cache; the shared Program must not be changed."""
+    try:
+        key = _program_key(instructions, macros, builtins)
+    except TypeError:  # an unhashable part: compile uncached, errors included
+        return compile_program(instructions, macros, builtins)
+    return _compile_cached(key)
+
+
+@lru_cache(maxsize=128)
+def _compile_cached(key):
+    instructions, macros, builtins = key
+    return compile_program(list(instructions), {spec[0]: spec[1:] for spec in macros},
+                           dict(builtins))
+
+
+def _run_memo(instructions, inputs, macros, builtins, max_steps):
+    """(steps, named vars) of a compiled run, from the cache when possible."""
+    _validate_inputs(inputs)
+    try:
+        key = _program_key(instructions, macros, builtins)
+    except TypeError:  # e.g. an unhashable builtin: run uncached
+        return _run_named(instructions, inputs, macros, builtins, max_steps)
+    return _run_cached(key, tuple(sorted((inputs or {}).items())), max_steps)
+
+
+@lru_cache(maxsize=1024)
+def _run_cached(key, inputs, max_steps):
+    # the returned dict is shared by every hit; callers copy it
+    return _run_on(_compile_cached(key), dict(inputs), max_steps)
+
+
+def _run_named(instructions, inputs, macros, builtins, max_steps):
+    """(steps, named vars) of one compiled run."""
+    return _run_on(_compiled(instructions, macros, builtins), inputs, max_steps)
+
+
+def _run_on(program, inputs, max_steps):
+    vars_ = program.make_vars(inputs)
+    steps = _execute(program, vars_, max_steps)
+    return steps, program.named_vars(vars_)
 
 
 # Macros for the S-language interpreter.
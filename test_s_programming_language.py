@@ -0,0 +1,733 @@
+"""Compiled engines checked against SMachine.run on the stock macro sets."""
+import io
+import unittest
+from contextlib import redirect_stdout
+from unittest import mock
+
+import s_programming_language as s
+
+MACROS = {**s.example_ece664_macros, **s.primitive_recursive_ece664_macros}
+MAX_STEPS = 1_000_000
+
+CASES = [
+    ([(name, "y", "x1", "x2")], {"x1": a, "x2": b})
+    for name in ("add", "mul", "recurse_add", "recurse_mul", "recurse_prim_sub", "recurse_abs_dif",
+                 "equal_test", "less_than_or_equal", "less_than")
+    for a, b in ((0, 0), (0, 3), (2, 0), (3, 2), (2, 4))
+] + [
+    ([(name, "y", "x1", "x2")], {"x1": a, "x2": b})
+    for name in ("recurse_exponent", "divisor", "integral_quotient", "remainder")
+    for a, b in ((0, 1), (2, 3), (3, 2), (6, 3))
+] + [
+    ([(name, "y", "x")], {"x": a})
+    for name in ("recurse_factorial", "pred", "alpha_pred", "prime")
+    for a in (0, 1, 4, 5)
+] + [
+    ([("subtract", "y", "x1", "x2")], {"x1": 5, "x2": 3}),
+    ([("n_prime", "y", "x")], {"x": 2}),
+    ([("zeros", "x1"), ("equals", "y", "x1")], {"x1": 3}),
+    ([("inc", "y"), ("inc", "y"), ("inc", "y"), ("dec", "x1"), ("dec", "x1"), ("dec", "x1"),
+      ("jnz", "x1", "E"), ("dec", "y"), ("dec", "y"), ("E:",)], {"x1": 2}),
+    ([("equals", "y", "x1"), ("equals", "z", "x2"), ("B:",), ("jnz", "z", "A"), ("goto", "E"),
+      ("A:",), ("dec", "z"), ("inc", "y"), ("goto", "B"), ("E:",)], {"x1": 2, "x2": 3}),
+]
+
+DEAD_STORE_MACROS = {
+    **MACROS,
+    "keep": (["y", "x"], [("equals", "_t", "x"), ("equals", "y", "x")], ["_t"]),
+    "keep_loop": (["y", "x"], [("equals", "_c", "x"), ("A:",), ("jnz", "_c", "B"), ("goto", "E"),
+                               ("B:",), ("dec", "_c"), ("inc", "y"), ("inc", "_w"), ("goto", "A"),
+                               ("E:",)], ["_c", "_w"]),
+}
+DEAD_STORE_CASES = [
+    ([(name, "y", "x1")], {"x1": a}) for name in ("keep", "keep_loop") for a in (0, 3)
+] + [([("add", "y", "x1", "x2")], {"x1": 2, "x2": 3})]
+
+
+def machine(program, inputs, macros=MACROS, **options):
+    vm = s.SMachine(macros, **options)
+    vm.set_inputs(inputs)
+    vm.set_program(program)
+    return vm
+
+
+def reference(program, inputs, macros=MACROS):
+    vm = machine(program, inputs, macros)
+    return vm.run(max_steps=MAX_STEPS), vm.vars
+
+
+def stepped(program, inputs, macros=MACROS, **options):
+    vm = machine(program, inputs, macros, **options)
+    vm.reset()
+    while vm.stack:
+        vm.step()
+    return vm
+
+
+class EngineTest(unittest.TestCase):
+
+    def assertMatches(self, named, expected):
+        for name, value in named.items():
+            self.assertEqual(value, expected.get(name, 0), name)
+
+    def test_run_program(self):
+        for program, inputs in CASES:
+            with self.subTest(program=program[0], inputs=inputs):
+                self.assertEqual(s.run_program(program, inputs, MACROS, MAX_STEPS),
+                                 reference(program, inputs)[0])
+
+    def test_run_program_without_numba(self):
+        with mock.patch.object(s, "_run_njit", None):
+            for program, inputs in CASES:
+                with self.subTest(program=program[0], inputs=inputs):
+                    compiled = s.compile_program(program, MACROS)
+                    vars_ = compiled.make_vars(inputs)
+                    s._execute(compiled, vars_, MAX_STEPS)
+                    self.assertMatches(compiled.named_vars(vars_), reference(program, inputs)[1])
+
+    def test_run_compiled(self):
+        for program, inputs in CASES:
+            with self.subTest(program=program[0], inputs=inputs):
+                vm = s.SMachine(MACROS)
+                vm.set_inputs(inputs)
+                vm.set_program(program)
+                y, expected = reference(program, inputs)
+                self.assertEqual(vm.run_compiled(max_steps=MAX_STEPS), y)
+                self.assertMatches({k: v for k, v in vm.vars.items() if "__" not in k}, expected)
+
+    def test_frame_pool_dropped(self):
+        # recursive calls grow a frame pool past the program's slots; neither
+        # engine hands it back
+        compiled = s.compile_program([("recurse_mul", "y", "x1", "x2")], MACROS)
+        for njit in (s._run_njit, None):
+            with self.subTest(numba=njit is not None), mock.patch.object(s, "_run_njit", njit):
+                vars_ = compiled.make_vars({"x1": 6, "x2": 7})
+                size = len(vars_)
+                s._execute(compiled, vars_, MAX_STEPS)
+                self.assertEqual(len(vars_), size)
+                self.assertEqual(compiled.named_vars(vars_)["y"], 42)
+
+    @unittest.skipIf(s._run_njit is None, "needs numba")
+    def test_no_calls_share_empty_pool(self):
+        # a program without calls runs on the shared empty pool and leaves it so
+        runs = 0
+        for program, inputs in CASES:
+            compiled = s.compile_program(program, MACROS)
+            if compiled.calls:
+                continue
+            vars_ = compiled.make_vars(inputs)
+            s._execute_native(compiled, vars_, MAX_STEPS)
+            self.assertMatches(compiled.named_vars(vars_), reference(program, inputs)[1])
+            runs += 1
+        self.assertTrue(runs)
+        self.assertFalse(any(a.any() for a in s._NO_CALLS))
+
+    def test_threaded_code_reused(self):
+        # _interpret() builds a program's closures once; watch_spins() rewrites
+        # ops, so it drops them
+        program = s.compile_program([("remainder", "y", "x1", "x2")], MACROS)
+
+        def remainder(a):
+            vars_ = program.make_vars({"x1": a, "x2": 5})
+            s._execute(program, vars_, MAX_STEPS)
+            return program.named_vars(vars_)["y"]
+
+        with mock.patch.object(s, "_run_njit", None):
+            self.assertEqual(remainder(17), 2)
+            threaded = program.threaded
+            self.assertEqual(remainder(9), 4)
+            self.assertIs(program.threaded, threaded)
+            s.watch_spins(program)
+            self.assertIsNone(program.threaded)
+            self.assertEqual(remainder(17), 2)
+
+    def test_jit(self):
+        for program, inputs in CASES:
+            with self.subTest(program=program[0], inputs=inputs):
+                run = s.jit(s.compile_program(program, MACROS))
+                self.assertEqual(run(inputs, MAX_STEPS), reference(program, inputs)[0])
+
+    def test_step_limit(self):
+        program, inputs = [("subtract", "y", "x1", "x2")], {"x1": 1, "x2": 3}
+        with self.assertRaises(RuntimeError):
+            s.run_program(program, inputs, MACROS, max_steps=5000)
+        with self.assertRaises(RuntimeError):
+            s.jit(s.compile_program(program, MACROS))(inputs, 5000)
+
+
+class BuiltinTest(unittest.TestCase):
+
+    def machine(self, program, inputs):
+        vm = s.SMachine(MACROS)
+        vm.register_builtin("add", lambda a, b: a + b)
+        vm.set_inputs(inputs)
+        vm.set_program(program)
+        return vm
+
+    def test_one_step_per_call(self):
+        # each call is one step that writes its output and nothing else
+        program, inputs = [("add", "z", "x1", "x2"), ("add", "y", "z", "x1")], {"x1": 2, "x2": 3}
+        expected = {"x1": 2, "x2": 3, "z": 5, "y": 7}
+        stepped = self.machine(program, inputs)
+        stepped.reset()
+        while stepped.step():
+            pass
+        ran, compiled = self.machine(program, inputs), self.machine(program, inputs)
+        self.assertEqual(ran.run(), 7)
+        self.assertEqual(compiled.run_compiled(), 7)
+        for vm in (stepped, ran, compiled):
+            self.assertEqual(vm.step_count, 2)
+            self.assertEqual(vm.vars, expected)
+
+    def test_builtin_replaces_macro(self):
+        builtins = {"add": lambda a, b: a + b}
+        for a, b in ((0, 0), (3, 2), (2, 40)):
+            program, inputs = [("mul", "y", "x1", "x2")], {"x1": a, "x2": b}
+            self.assertEqual(s.run_program(program, inputs, MACROS, builtins=builtins), a * b)
+
+    def test_builtin_on_numba(self):
+        # builtins are called between runs of the Numba loop, not instead of it
+        program, inputs = [("mul", "y", "x1", "x2")], {"x1": 6, "x2": 7}
+        with mock.patch.object(s, "_interpret", wraps=s._interpret) as interpret:
+            self.assertEqual(s.run_program(program, inputs, MACROS,
+                                           builtins={"add": lambda a, b: a + b}), 42)
+        self.assertEqual(interpret.called, s._run_njit is None)
+
+    def test_builtin_past_njit_limit(self):
+        # a builtin result too big for int64 finishes the run in _interpret()
+        x1 = s._NJIT_LIMIT - 1
+        program = [("add", "z", "x1", "x2"), ("inc", "z"), ("equals", "y", "z")]
+        builtins = {"add": lambda a, b: a + b}
+        self.assertEqual(s.run_program(program, {"x1": x1, "x2": 5}, MACROS, builtins=builtins),
+                         x1 + 6)
+
+    def test_memoize_macro(self):
+        program = [("mul", "z", "x1", "x2"), ("mul", "y", "x2", "x1"), ("mul", "y", "x1", "x2")]
+        vm = s.SMachine(MACROS)
+        vm.memoize_macro("mul")
+        vm.set_inputs({"x1": 3, "x2": 4})
+        vm.set_program(program)
+        self.assertEqual(vm.run(), 12)
+        self.assertEqual(vm.step_count, 3)
+        self.assertEqual(vm.builtins["mul"].cache_info().hits, 1)
+        self.assertEqual(vm.builtins["mul"].cache_info().misses, 2)
+
+    def test_memoize_rejects_macro_reading_output(self):
+        # recurse_add_core adds onto y, so its result depends on y's old value
+        vm = s.SMachine(MACROS)
+        with self.assertRaises(ValueError):
+            vm.memoize_macro("recurse_add_core")
+        self.assertNotIn("recurse_add_core", vm.builtins)
+        # so does one that can leave y untouched
+        vm.add_macro("keep", ["y", "x"], [("jnz", "x", "E"), ("zeros", "y"), ("E:",)])
+        with self.assertRaises(ValueError):
+            vm.memoize_macro("keep")
+        vm.memoize_macro("recurse_add")
+
+
+class MemoTest(unittest.TestCase):
+
+    def test_hit(self):
+        program, inputs = [("mul", "y", "x1", "x2")], {"x1": 6, "x2": 7}
+        self.assertEqual(s.run_program(program, inputs, MACROS, memo=True), 42)
+        hits = s._run_cached.cache_info().hits
+        vm = machine(program, inputs)
+        self.assertEqual(vm.run_compiled(memo=True), 42)
+        self.assertEqual(s._run_cached.cache_info().hits, hits + 1)
+        fresh = machine(program, inputs)
+        fresh.run_compiled()
+        self.assertEqual(vm.step_count, fresh.step_count)
+        self.assertEqual(vm.vars, fresh.vars)
+
+    def test_macro_changed_between_runs(self):
+        # the cache is keyed by content, so an edited macro is a new program
+        macros = {**MACROS, "double": (["y", "x"], [("add", "y", "x", "x")])}
+        program, inputs = [("double", "y", "x1")], {"x1": 4}
+        self.assertEqual(s.run_program(program, inputs, macros, memo=True), 8)
+        macros["double"][1][0] = ("mul", "y", "x", "x")
+        self.assertEqual(s.run_program(program, inputs, macros, memo=True), 16)
+
+    def test_unhashable_builtin(self):
+        class Add:
+            __hash__ = None
+
+            def __call__(self, a, b):
+                return a + b
+
+        program, inputs = [("mul", "y", "x1", "x2")], {"x1": 6, "x2": 7}
+        self.assertEqual(s.run_program(program, inputs, MACROS, builtins={"add": Add()},
+                                       memo=True), 42)
+
+
+class BytecodeCacheTest(unittest.TestCase):
+
+    def test_reused_across_inputs(self):
+        program = [("mul", "y", "x1", "x2")]
+        s.run_program(program, {"x1": 2, "x2": 3}, MACROS)
+        hits = s._compile_cached.cache_info().hits
+        self.assertEqual(s.run_program(program, {"x1": 6, "x2": 7}, MACROS), 42)
+        self.assertEqual(s._compile_cached.cache_info().hits, hits + 1)
+
+    def test_macro_changed_between_runs(self):
+        macros = {**MACROS, "double": (["y", "x"], [("add", "y", "x", "x")])}
+        program, inputs = [("double", "y", "x1")], {"x1": 4}
+        self.assertEqual(s.run_program(program, inputs, macros), 8)
+        macros["double"][1][0] = ("mul", "y", "x", "x")
+        self.assertEqual(s.run_program(program, inputs, macros), 16)
+
+    def test_unhashable_part(self):
+        # a program with an unhashable builtin compiles uncached, with the same result
+        class Add:
+            __hash__ = None
+
+            def __call__(self, a, b):
+                return a + b
+
+        misses = s._compile_cached.cache_info().misses
+        self.assertEqual(s.run_program([("mul", "y", "x1", "x2")], {"x1": 6, "x2": 7}, MACROS,
+                                       builtins={"add": Add()}), 42)
+        self.assertEqual(s._compile_cached.cache_info().misses, misses)
+
+
+class StepperTest(unittest.TestCase):
+
+    def assertSameRun(self, ran, stepped_vm):
+        self.assertEqual(ran.step_count, stepped_vm.step_count)
+        self.assertEqual(ran.vars, stepped_vm.vars)
+
+    def test_run_matches_step(self):
+        # run()'s loop takes shortcuts that step() does not; the steps counted
+        # and every variable, macro locals included, must still agree
+        for program, inputs in CASES:
+            with self.subTest(program=program[0], inputs=inputs):
+                ran = machine(program, inputs)
+                ran.run(max_steps=MAX_STEPS)
+                self.assertSameRun(ran, stepped(program, inputs))
+
+    def test_print_steps(self):
+        program, inputs = [("recurse_mul", "y", "x1", "x2")], {"x1": 3, "x2": 4}
+        ran, out = machine(program, inputs), io.StringIO()
+        with redirect_stdout(out):
+            ran.run(print_steps=100)
+        expected = stepped(program, inputs)
+        self.assertSameRun(ran, expected)
+        self.assertEqual(out.getvalue().split("\n")[:-1],
+                         [f"Executing step {k}" for k in range(100, expected.step_count, 100)])
+
+    def test_redefined_macro(self):
+        # decoded bodies are cached per definition, so add_macro replaces them
+        vm = machine([("twice", "y", "x1")], {"x1": 4},
+                     {**MACROS, "twice": (["y", "x"], [("add", "y", "x", "x")])})
+        self.assertEqual(vm.run(), 8)
+        vm.add_macro("twice", ["y", "x"], [("mul", "y", "x", "x")])
+        vm.reset()
+        self.assertEqual(vm.run(), 16)
+        # the call to twice is one step more than mul on its own
+        alone = stepped([("mul", "y", "x1", "x1")], {"x1": 4})
+        self.assertEqual(vm.step_count, alone.step_count + 1)
+
+    def test_bind_site(self):
+        # a call site caches its binding: globals as they are, the caller's
+        # params and locals through its map, the last of repeated params winning
+        macros = {**MACROS,
+                  "pair": (["a", "b"], [("inc", "a"), ("inc", "b"), ("inc", "b")], []),
+                  "dup": (["a", "a"], [("inc", "a")], []),
+                  "outer": (["x"], [("pair", "x", "g"), ("pair", "_t", "x"), ("dup", "x", "_t"),
+                                    ("equals", "y", "_t")], ["_t"])}
+        program = [("outer", "x1"), ("outer", "x2")]
+        ran = machine(program, {}, macros)
+        ran.run()
+        self.assertSameRun(ran, stepped(program, {}, macros))
+        self.assertEqual(ran.vars["x1"], 3)
+        self.assertEqual(ran.vars["g"], 4)
+        self.assertEqual(ran.vars["y"], 2)
+        # replacing a macro rebuilds the binding at sites that were already run
+        ran.add_macro("pair", ["b", "a"], [("inc", "a"), ("inc", "b"), ("inc", "b")])
+        ran.reset()
+        ran.run()
+        expected = stepped(program, {}, {**macros, "pair": ran.macros["pair"]})
+        self.assertEqual(ran.step_count, expected.step_count)
+        self.assertEqual({k: v for k, v in ran.vars.items() if "__" not in k},
+                         {k: v for k, v in expected.vars.items() if "__" not in k})
+        self.assertEqual(ran.vars["g"], 2)
+
+    def test_local_names(self):
+        # a call's locals are named after its call id, in run() and step() alike,
+        # even for the gotos the shortcut runs without a frame
+        program, inputs = [("equals", "y", "x1"), ("goto", "E"), ("E:",)], {"x1": 2}
+        vm = machine(program, inputs)
+        vm.reset()
+        vm.run()
+        self.assertEqual(vm.vars, stepped(program, inputs).vars)
+        self.assertEqual(vm.vars["_z__m0"], 0)
+        self.assertEqual(vm.vars["_z__m8"], 1)  # the last goto's
+
+    def test_malformed_primitive(self):
+        # extra operands are ignored; a jnz without a label fails when reached
+        vm = machine([("inc", "y", "z"), ("jnz", "y")], {})
+        vm.reset()
+        vm.step()
+        self.assertEqual(vm.vars, {"y": 1})
+        with self.assertRaises(IndexError):
+            vm.step()
+
+    def test_goto_shortcut(self):
+        # run() takes a goto-shaped call as one jump of three steps, even out of
+        # a macro or over a global; a step limit inside one stops where step() would
+        macros = {**MACROS, "leave": (["lab"], [("goto", "lab")]),
+                  "bump_to": (["lab"], [("inc", "g"), ("jnz", "g", "lab")])}
+        program = [("goto", "A"), ("inc", "y"), ("A:",), ("leave", "E"), ("inc", "y"), ("E:",),
+                   ("bump_to", "F"), ("inc", "y"), ("F:",), ("inc", "y")]
+        ran, expected = machine(program, {}, macros), stepped(program, {}, macros)
+        self.assertEqual(ran.run(), 1)
+        self.assertSameRun(ran, expected)
+        for limit in range(1, expected.step_count):
+            ran, partial = machine(program, {}, macros), machine(program, {}, macros)
+            with self.assertRaises(RuntimeError):
+                ran.run(max_steps=limit)
+            partial.reset()
+            for _ in range(limit):
+                partial.step()
+            self.assertSameRun(ran, partial)
+        with self.assertRaisesRegex(KeyError, "Label 'Z' not found"):
+            machine([("goto", "Z")], {}).run()
+
+    def test_transfer_loop(self):
+        # run() does all passes of L: dec x; inc t...; jnz x L at once, unless
+        # a target is x itself through the macro's params (then it never ends)
+        macros = {**MACROS, "move": (["t", "u", "x"], [("L:",), ("dec", "x"), ("inc", "t"),
+                                                      ("inc", "u"), ("jnz", "x", "L")])}
+        for program, inputs in (([("move", "y", "z", "x1")], {"x1": 5}),
+                                ([("move", "y", "z", "x1")], {"x1": 0}),
+                                ([("move", "y", "y", "x1")], {"x1": 3}),
+                                ([("move", "x1", "y", "x1")], {"x1": 3})):
+            with self.subTest(program=program, inputs=inputs):
+                for limit in range(1, 30):
+                    ran = machine(program, inputs, macros)
+                    partial = machine(program, inputs, macros)
+                    try:
+                        ran.run(max_steps=limit)
+                    except RuntimeError:
+                        pass
+                    partial.reset()
+                    while partial.stack and partial.step_count < limit:
+                        partial.step()
+                    self.assertSameRun(ran, partial)
+
+    def test_frame_pool(self):
+        # finished frames are reused by later calls and runs, never recorded ones
+        program, inputs = [("recurse_mul", "y", "x1", "x2")], {"x1": 3, "x2": 4}
+        vm, expected = machine(program, inputs), stepped(program, inputs)
+        self.assertEqual(vm.run(), 12)
+        self.assertEqual((vm.step_count, vm.vars), (expected.step_count, expected.vars))
+        self.assertTrue(vm._frame_pool)
+        vm.reset()  # call ids go on counting, so only globals repeat
+        self.assertEqual(vm.run(), 12)
+        self.assertEqual(vm.step_count, expected.step_count)
+        # step() takes from and returns to the same pool
+        expected.reset()
+        with mock.patch.object(s, "_Frame", wraps=s._Frame) as new_frame:
+            while expected.stack:
+                expected.step()
+        self.assertEqual(new_frame.call_count, 0)
+        self.assertEqual(expected.vars["y"], 12)
+        recorded = machine(program, inputs, history=True)
+        recorded.run()
+        self.assertFalse(recorded._frame_pool)
+
+
+def max_depth(vm, stride=7):
+    # the deepest stack seen when run() stops every stride steps
+    vm.reset()
+    deepest, limit = 0, stride
+    while vm.stack:
+        try:
+            vm.run(max_steps=limit)
+        except RuntimeError:
+            pass
+        deepest, limit = max(deepest, len(vm.stack)), limit + stride
+    return deepest
+
+
+class TailCallTest(unittest.TestCase):
+
+    def test_constant_depth(self):
+        for program, small, large in (([("recurse_add", "y", "x1", "x2")],
+                                       {"x1": 3, "x2": 20}, {"x1": 3, "x2": 200}),
+                                      ([("recurse_factorial", "y", "x")], {"x": 3}, {"x": 5})):
+            with self.subTest(program=program[0]):
+                depths = []
+                for inputs in (small, large):
+                    vm = machine(program, inputs)
+                    depths.append(max_depth(vm))
+                    expected = stepped(program, inputs)
+                    self.assertEqual(vm.vars["y"], expected.vars["y"])
+                    self.assertEqual(vm.step_count, expected.step_count)
+                    self.assertEqual(vm.vars, expected.vars)
+                self.assertEqual(depths[0], depths[1])
+                # recorded runs keep every frame for rewind
+                self.assertGreater(max_depth(machine(program, large, history=True)), depths[1])
+
+    def test_escapes_kept_across_runs(self):
+        # the label escape analysis is redone only once the macros change
+        vm = machine([("recurse_add", "y", "x1", "x2")], {"x1": 3, "x2": 20})
+        self.assertEqual(vm.run(), 23)
+        escapes = vm._escapes
+        self.assertIsNotNone(escapes)
+        vm.reset()
+        self.assertEqual(vm.run(), 23)
+        self.assertIs(vm._escapes, escapes)
+        vm.add_macro("bump", ["x"], [("inc", "x")])
+        vm.reset()
+        self.assertEqual(vm.run(), 23)
+        self.assertIsNot(vm._escapes, escapes)
+
+    def test_jump_to_callers_label(self):
+        # the callee jumps to a label of the frame that tail-called it, so
+        # that frame must stay on the stack
+        macros = {
+            "jumper": (["v"], [("jnz", "v", "L")], []),
+            "outer": (["v"], [("L:",), ("dec", "v"), ("inc", "y"), ("jumper", "v")], []),
+            "jumper2": (["v", "lab"], [("jnz", "v", "lab")], []),
+            "outer2": (["v", "lab"], [("dec", "v"), ("inc", "y"), ("jumper2", "v", "lab")], []),
+        }
+        for program, inputs in (([("outer", "x")], {"x": 4}),
+                                ([("M:",), ("outer2", "x", "M")], {"x": 4}),
+                                ([("outer2", "x", "Q"), ("Q:",)], {"x": 0}),
+                                ([("inc", "x"), ("P:",), ("outer2", "x", "P")], {"x": 3})):
+            with self.subTest(program=program):
+                ran = machine(program, inputs, macros)
+                expected = stepped(program, inputs, macros)
+                self.assertEqual(ran.run(), expected.vars["y"])
+                self.assertEqual((ran.step_count, ran.vars), (expected.step_count, expected.vars))
+
+
+def view(snapshot, local_vars=True):
+    # the fields a history snapshot shares with SMachine.state()
+    stack = snapshot.get("stack")
+    top = stack[-1] if stack else snapshot.get("top_frame")
+    return {"step": snapshot["step"], "stack_depth": snapshot["stack_depth"],
+            "next_instr": snapshot["next_instr"], "pc": top and top["pc"],
+            "vars": {k: v for k, v in snapshot["vars"].items() if local_vars or "__" not in k}}
+
+
+class HistoryTest(unittest.TestCase):
+
+    def machine(self, history_stride=256):
+        vm = s.SMachine(MACROS, history=True, history_stride=history_stride)
+        vm.set_inputs({"x1": 2, "x2": 1})
+        vm.set_program([("add", "y", "x1", "x2"), ("goto", "E"), ("inc", "y"), ("E:",)])
+        vm.reset()
+        return vm
+
+    def stepped(self, vm, local_vars=True):
+        # the state before the first step and after every step, return or not
+        states = [view(vm.state(), local_vars)]
+        while vm.stack:
+            vm.step()
+            states.append(view(vm.state(), local_vars))
+        return states
+
+    def test_snapshots(self):
+        vm = self.machine()
+        states = self.stepped(vm)
+        history = vm.history
+        self.assertEqual(len(history), len(states))
+        self.assertEqual([view(history[i]) for i in range(len(history))], states)
+        self.assertEqual(view(history[-1]), states[-1])
+        self.assertEqual([view(h) for h in history[3:20:2]], states[3:20:2])
+        self.assertEqual([view(h) for h in history[::-1]], states[::-1])
+        self.assertEqual([view(h) for h in reversed(history)], states[::-1])
+        self.assertEqual([view(h) for h in history], states)
+
+    def test_off_by_default(self):
+        vm = machine([("add", "y", "x1", "x2")], {"x1": 2, "x2": 1})
+        self.assertEqual(vm.run(), 3)
+        self.assertEqual(len(vm.history), 0)
+        with self.assertRaisesRegex(RuntimeError, "history=True"):
+            vm.rewind(0)
+        with self.assertRaisesRegex(RuntimeError, "history=True"):
+            vm.print_state(0)
+
+    def test_run_records_as_step(self):
+        # run() logs its own entries, outward jumps included
+        body = [("add", "y", "v", "v"), ("jnz", "v", "lab")]
+        macros = {**MACROS, "exit_if": (["v", "lab"], body)}
+        program = [("exit_if", "x1", "E"), ("inc", "y"), ("E:",)]
+        for x1 in (0, 2):
+            ran = machine(program, {"x1": x1}, macros, history=True)
+            ran.run()
+            expected = machine(program, {"x1": x1}, macros, history=True)
+            expected.reset()
+            states = self.stepped(expected)
+            self.assertEqual([view(h) for h in ran.history], states)
+
+    def test_state_views(self):
+        # vars is a copy; the top frame is a read-only view of the running call
+        vm = self.machine()
+        for _ in range(3):
+            vm.step()
+        state = vm.state()
+        state["vars"]["y"] = 99
+        self.assertNotEqual(vm.vars["y"], 99)
+        frame = state["top_frame"]
+        self.assertIs(frame["code"], vm.stack[-1].code)
+        self.assertIsInstance(frame["code"], tuple)
+        with self.assertRaises(TypeError):
+            frame["labels"]["Z"] = 0
+        with self.assertRaises(TypeError):
+            frame["map"]["x"] = "x9"
+        self.assertEqual(view(vm.state()), view(vm.history[-1]))
+
+    def test_snapshots_are_read_only(self):
+        # snapshots share the frames' bodies, so nothing in them can be changed
+        vm = self.machine()
+        self.stepped(vm)
+        for snapshot in vm.history[:5]:
+            for frame in snapshot["stack"]:
+                self.assertIsInstance(frame["code"], tuple)
+                with self.assertRaises(TypeError):
+                    frame["labels"]["Z"] = 0
+                with self.assertRaises(TypeError):
+                    frame["map"]["x"] = "x9"
+
+    def test_checkpoints(self):
+        # snapshots rebuilt from checkpoints match a walk from the live state
+        states = self.stepped(self.machine())
+        for stride in (0, 1, 5, 16):
+            with self.subTest(stride=stride):
+                vm = self.machine(stride)
+                self.stepped(vm)
+                for i in (100, 3, 57, 58, 0, len(states) - 1, 20, 99, 5, 100):
+                    self.assertEqual(view(vm.history[i]), states[i])
+                self.assertEqual([view(h) for h in vm.history[10:90:3]], states[10:90:3])
+                self.assertEqual(bool(vm.history._checkpoints), bool(stride))
+
+    def test_checkpoint_count(self):
+        # the stride grows with the history: one walk leaves at most _CHECKPOINTS
+        vm = self.machine(1)
+        states = self.stepped(vm)
+        self.assertGreater(len(states), s._CHECKPOINTS)
+        self.assertEqual([view(h) for h in reversed(vm.history)], states[::-1])
+        self.assertLessEqual(len(vm.history._checkpoints), s._CHECKPOINTS)
+
+    def test_rewind_past_checkpoints(self):
+        # rewinding drops the checkpoints above idx; walks after the replay
+        # must not start from them
+        vm = self.machine(5)
+        states = self.stepped(vm, local_vars=False)
+        list(vm.history)
+        vm.rewind(17)
+        self.assertLessEqual(max(vm.history._checkpoints), 17)
+        self.assertEqual(self.stepped(vm, False), states[17:])
+        self.assertEqual([view(h, False) for h in vm.history], states)
+        for i in (120, 16, 17, 18, 60):
+            self.assertEqual(view(vm.history[i], False), states[i])
+
+    def test_rewind_then_continue(self):
+        # call ids are not rewound, so a replayed call names its locals anew
+        vm = self.machine()
+        states = self.stepped(vm, local_vars=False)
+        for k in (len(states) - 1, 17, 4, 0):
+            vm.rewind(k)
+            self.assertEqual(len(vm.history), k + 1)
+            self.assertEqual(view(vm.state(), False), states[k])
+            self.assertEqual(self.stepped(vm, False), states[k:])
+            self.assertEqual(vm.vars["y"], 3)
+
+
+class CompilerTest(unittest.TestCase):
+
+    def test_recursive_segments(self):
+        # recurse_add recurses x2 deep, past the 64 frames the Numba loop starts with
+        for program, inputs, y in (([("recurse_mul", "y", "x1", "x2")], {"x1": 6, "x2": 7}, 42),
+                                   ([("recurse_add", "y", "x1", "x2")], {"x1": 7, "x2": 200}, 207)):
+            self.assertTrue(s.compile_program(program, MACROS).calls)
+            self.assertEqual(s.run_program(program, inputs, MACROS, MAX_STEPS), y)
+            with mock.patch.object(s, "_run_njit", None):
+                self.assertEqual(s.run_program(program, inputs, MACROS, MAX_STEPS), y)
+
+    def test_recursive_past_njit_limit(self):
+        # the Numba loop hands the run to _interpret() deep in the recursion,
+        # frame pool and all, once a sum would pass _NJIT_LIMIT
+        x1 = s._NJIT_LIMIT - 3
+        program, inputs = [("recurse_add", "y", "x1", "x2")], {"x1": x1, "x2": 70}
+        self.assertEqual(s.run_program(program, inputs, MACROS, MAX_STEPS), x1 + 70)
+
+    def test_no_jump_to_next(self):
+        # a goto straight to the label after it compiles to nothing
+        for name in ("remainder", "less_than", "recurse_mul"):
+            program = s.compile_program([(name, "y", "x1", "x2")], MACROS)
+            jumps = [pc for pc, op in enumerate(program.ops) if op == s.OP_JMP]
+            self.assertTrue(jumps)
+            for pc in jumps:
+                self.assertNotEqual(program.arg2[pc], pc + 1, name)
+
+    def test_dead_stores(self):
+        # writes to _t and _w are never read, nor is the copy add leaves in _y
+        for program, inputs in DEAD_STORE_CASES:
+            compiled = s.compile_program(program, DEAD_STORE_MACROS)
+            vars_ = compiled.make_vars(inputs)
+            s._execute(compiled, vars_, MAX_STEPS)
+            _, expected = reference(program, inputs, DEAD_STORE_MACROS)
+            self.assertEqual(compiled.named_vars(vars_)["y"], expected["y"], program)
+            with mock.patch.object(s._Compiler, "_drop_dead_stores"):
+                kept = s.compile_program(program, DEAD_STORE_MACROS)
+            self.assertLess(len(compiled.ops), len(kept.ops), program)
+
+    def test_counted_loop(self):
+        # mul's outer loop adds x1 to y x2 times in one op, whatever x2 is
+        program = s.compile_program([("mul", "y", "x1", "x2")], MACROS)
+        self.assertIn(s.OP_LOOP, program.ops)
+        counts = set()
+        for b in (1, 2, 300):
+            vars_ = program.make_vars({"x1": 7, "x2": b})
+            counts.add(s._execute(program, vars_, MAX_STEPS))
+            self.assertEqual(program.named_vars(vars_)["y"], 7 * b)
+        self.assertEqual(len(counts), 1)
+
+    def test_loop_past_njit_limit(self):
+        # the Numba loop hands a product that would pass _NJIT_LIMIT to _interpret()
+        x1 = s._NJIT_LIMIT // 2 + 1
+        program, inputs = [("mul", "y", "x1", "x2")], {"x1": x1, "x2": 3}
+        with mock.patch.object(s, "_interpret", wraps=s._interpret) as interpret:
+            self.assertEqual(s.run_program(program, inputs, MACROS), 3 * x1)
+        self.assertEqual(interpret.called, s._run_njit is not None)
+        self.assertEqual(s.jit(s.compile_program(program, MACROS))(inputs, MAX_STEPS), 3 * x1)
+
+    def test_label_errors(self):
+        # SMachine finds a label param or a caller's label at run time; a
+        # compiled recursive call has no caller frame to jump into
+        macros = {**MACROS, "count_down": (["x", "L"], [("jnz", "x", "A"), ("goto", "L"), ("A:",),
+                                                        ("dec", "x"), ("count_down", "x", "L")])}
+        program = [("count_down", "x1", "E"), ("inc", "y"), ("E:",)]
+        self.assertEqual(reference(program, {"x1": 3}, macros)[0], 0)
+        with self.assertRaisesRegex(ValueError, "Label 'L' leaves recursive macro 'count_down'"):
+            s.compile_program(program, macros)
+        # a missing label only fails once the jump is taken, as in SMachine
+        program = [("jnz", "x1", "E"), ("inc", "y")]
+        self.assertEqual(s.run_program(program, {"x1": 0}, MACROS),
+                         reference(program, {"x1": 0})[0])
+        for run in (s.run_program, reference):
+            with self.assertRaisesRegex(KeyError, "Label 'E' not found in any frame"):
+                run(program, {"x1": 1}, MACROS)
+
+
+class CheckProgramTest(unittest.TestCase):
+
+    def test_spin_loop(self):
+        # subtract with x2 > x1 ends up jumping between two labels forever
+        program, inputs = [("subtract", "y", "x1", "x2")], {"x1": 1, "x2": 3}
+        self.assertRegex(s.check_program(program, inputs, MACROS), "^Infinite loop")
+        with self.assertRaisesRegex(RuntimeError, "Infinite loop"):
+            s.run_program(program, inputs, MACROS, validate=True)
+
+    def test_terminating(self):
+        program, inputs = [("subtract", "y", "x1", "x2")], {"x1": 5, "x2": 3}
+        self.assertIsNone(s.check_program(program, inputs, MACROS))
+        self.assertEqual(s.run_program(program, inputs, MACROS, validate=True), 2)
+        self.assertIsNone(s.check_program([("mul", "y", "x1", "x2")], {"x1": 3, "x2": 4}, MACROS))
+
+
+if __name__ == "__main__":
+    unittest.main()